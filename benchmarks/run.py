@@ -0,0 +1,362 @@
+"""
+benchmarks/run.py
+
+Load test for the whole server. Starts the server against a temporary SQLite file and a local
+stand-in target (benchmarks/target.py), seeds users and jobs through the real /register, /login and
+/job routes, lets the jobs fire for a while, then reports as JSON:
+
+* fires per second, and the schedule skew percentiles (from the server's /metrics, which includes
+  the scheduler worker processes when sharding)
+* database writes per second
+* API latency percentiles, for creating jobs and for listing them while the jobs fire
+* peak RSS of the server, added up over its worker processes
+
+    $ python3 -m benchmarks.run --users 10 --jobs 1000 --interval 5 --duration 30 > run.json
+
+Runs with the same arguments and seed are comparable over time.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.platform.asyncio import AsyncIOMainLoop, to_asyncio_future
+from urllib.parse import urlencode
+
+
+# Root of the repository, where the server is started from
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    """A port nothing is listening on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Percentiles of a list of values, by nearest rank."""
+    if not values:
+        return {'p{}'.format(point): None for point in points}
+    values = sorted(values)
+    return {'p{}'.format(point): values[min(len(values) - 1, int(len(values) * point / 100))]
+            for point in points}
+
+
+def parse_metrics(text: str):
+    """Samples of a Prometheus text page, by name and labels."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+def histogram_percentiles(before: dict, after: dict, name: str, points=(50, 90, 99)):
+    """Percentiles of the values a histogram observed between two scrapes. Each percentile is the
+    upper bound of the bucket it falls in."""
+    prefix = name + '_bucket{le="'
+    buckets = []
+    for key, count in after.items():
+        if key.startswith(prefix):
+            bound = key[len(prefix):-2]
+            buckets.append((float('inf') if bound == '+Inf' else float(bound),
+                            count - before.get(key, 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    result = {}
+    for point in points:
+        result['p{}'.format(point)] = None
+        for bound, count in buckets:
+            if total and count >= total * point / 100:
+                result['p{}'.format(point)] = bound if bound != float('inf') else None
+                break
+    result['count'] = int(total)
+    return result
+
+
+class Benchmark(object):
+    """One run of the load test."""
+
+    def __init__(self, args):
+        """Constructor."""
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.work_dir = tempfile.mkdtemp(prefix='veggiecron-bench-')
+        self.db_file = os.path.join(self.work_dir, 'bench.db')
+        self.port = free_port()
+        self.target_port = free_port()
+        self.base_url = 'http://127.0.0.1:{}'.format(self.port)
+        self.http_client = AsyncHTTPClient(max_clients=args.concurrency)
+        self.processes = []
+
+    def write_config(self):
+        """Copy config.yaml with the port, database file and any overrides swapped in."""
+        with open(os.path.join(root, 'config.yaml')) as config_file:
+            config = yaml.safe_load(config_file)
+        config['app']['env'] = 'production'
+        config['port'] = self.port
+        config['db_file'] = self.db_file
+        config.setdefault('scheduler', {})['shards'] = self.args.shards
+        if self.args.backend:
+            config.setdefault('runner_options', {}).setdefault('http', {})['backend'] = \
+                self.args.backend
+        config_path = os.path.join(self.work_dir, 'config.yaml')
+        with open(config_path, 'w') as config_file:
+            yaml.safe_dump(config, config_file)
+        return config_path
+
+    def start(self, args, log_name, env=None):
+        """Start a process from the repository root, logging to the work directory."""
+        log = open(os.path.join(self.work_dir, log_name), 'w')
+        process = subprocess.Popen(args, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    async def request(self, path: str, method: str = 'GET', body: dict = None, token: str = None):
+        """Make a request to the server. Returns (seconds taken, parsed JSON or text)."""
+        headers = {'X-Auth-Token': token} if token else {}
+        started = time.monotonic()
+        try:
+            response = await to_asyncio_future(self.http_client.fetch(
+                self.base_url + path, method=method, headers=headers,
+                body=urlencode(body) if body is not None else None, request_timeout=60))
+        except HTTPError as e:
+            raise RuntimeError('{} {} failed: {}'.format(method, path, e))
+        elapsed = time.monotonic() - started
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return elapsed, json.loads(response.body.decode())
+        return elapsed, response.body.decode()
+
+    async def wait_for_server(self, timeout: float = 30):
+        """Wait until the server answers."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await self.request('/')
+                return
+            except Exception:
+                if time.monotonic() > deadline or self.processes[-1].poll() is not None:
+                    raise RuntimeError('The server did not start, see {}.'.format(
+                        os.path.join(self.work_dir, 'server.log')))
+                await asyncio.sleep(0.2)
+
+    async def seed(self):
+        """Create the users, then the jobs spread over them. Returns the job creation latencies and
+        the users' auth tokens."""
+        tokens = []
+        for user in range(self.args.users):
+            username = 'bench{}'.format(user)
+            await self.request('/register', 'POST', {'username': username, 'password': 'bench'})
+            _, login = await self.request('/login', 'POST',
+                                          {'username': username, 'password': 'bench'})
+            tokens.append(login['data']['token'])
+
+        latencies = []
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def create(job: int):
+            data = {
+                'url': 'http://127.0.0.1:{}/job/{}'.format(self.target_port, job),
+                'number_of_clones': self.args.clones,
+                'verb': 'GET',
+                'enable_shadows': False,
+            }
+            async with semaphore:
+                elapsed, _ = await self.request('/job', 'POST', {
+                    'name': 'bench{}'.format(job),
+                    'type': 'http',
+                    'data': json.dumps(data),
+                    'schedule': 'every {} seconds'.format(self.args.interval),
+                }, token=tokens[job % len(tokens)])
+            latencies.append(elapsed)
+
+        await asyncio.gather(*(create(job) for job in range(self.args.jobs)))
+        return latencies, tokens
+
+    def count_results(self):
+        """Number of job runs recorded so far."""
+        connection = sqlite3.connect('file:{}?mode=ro'.format(self.db_file), uri=True)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM job_result;').fetchone()[0]
+        finally:
+            connection.close()
+
+    async def measure(self, tokens):
+        """Let the jobs fire for the configured duration, listing jobs now and then meanwhile.
+        Returns (seconds measured, results before, results after, list latencies, metrics before,
+        metrics after)."""
+        _, metrics_before = await self.request('/metrics')
+        results_before = self.count_results()
+        started = time.monotonic()
+
+        list_latencies = []
+        while time.monotonic() - started < self.args.duration:
+            token = self.rng.choice(tokens)
+            elapsed, _ = await self.request('/job?limit=100', token=token)
+            list_latencies.append(elapsed)
+            await asyncio.sleep(self.args.probe_interval)
+
+        elapsed = time.monotonic() - started
+        results_after = self.count_results()
+        _, metrics_after = await self.request('/metrics')
+        return (elapsed, results_before, results_after, list_latencies,
+                parse_metrics(metrics_before), parse_metrics(metrics_after))
+
+    @staticmethod
+    def descendants(pid: int):
+        """Ids of a running process and of every process it started, from /proc."""
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(entry)) as stat:
+                    # The parent id follows the command name, which is in parentheses
+                    parent = int(stat.read().rpartition(')')[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+        pids = [pid]
+        for parent in pids:
+            pids.extend(children.get(parent, ()))
+        return pids
+
+    def peak_rss(self, process):
+        """Peak RSS in MB of a running process plus every process it started (such as the scheduler
+        workers), or None if it can't be read. Each process' own peak is added, so this is an upper
+        bound of their peak together."""
+        try:
+            pids = self.descendants(process.pid)
+        except OSError:
+            return None
+        total = None
+        for pid in pids:
+            try:
+                with open('/proc/{}/status'.format(pid)) as status:
+                    for line in status:
+                        if line.startswith('VmHWM:'):
+                            total = (total or 0) + int(line.split()[1])
+            except OSError:
+                pass
+        return round(total / 1024, 1) if total is not None else None
+
+    def stop(self):
+        """Stop the server and the target, returning the peak RSS of the server (and its workers)
+        in MB."""
+        peak = self.peak_rss(self.processes[-1])
+        for process in reversed(self.processes):
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        if peak is not None:
+            return peak
+
+        # Without /proc, fall back on the largest of the finished processes. ru_maxrss is in KB on
+        # Linux and in bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+    async def run(self):
+        """Run the benchmark and return its report."""
+        config_path = self.write_config()
+        self.start([sys.executable, '-m', 'benchmarks.target', '--port', str(self.target_port),
+                    '--latency', str(self.args.latency), '--jitter', str(self.args.jitter),
+                    '--error-rate', str(self.args.error_rate), '--seed', str(self.args.seed)],
+                   'target.log')
+        self.start([sys.executable, 'start.py'], 'server.log',
+                   env=dict(os.environ, VEGGIECRON_CONFIG=config_path))
+        try:
+            await self.wait_for_server()
+
+            seeding_started = time.monotonic()
+            create_latencies, tokens = await self.seed()
+            seeding_seconds = time.monotonic() - seeding_started
+
+            (elapsed, results_before, results_after, list_latencies, metrics_before,
+             metrics_after) = await self.measure(tokens)
+        finally:
+            peak_rss = self.stop()
+
+        writes = 'veggiecron_db_query_seconds_count{kind="write"}'
+        return {
+            'arguments': vars(self.args),
+            'seeding_seconds': round(seeding_seconds, 3),
+            'measured_seconds': round(elapsed, 3),
+            'fires_per_second': round((results_after - results_before) / elapsed, 2),
+            'expected_fires_per_second': round(self.args.jobs * self.args.clones /
+                                               self.args.interval, 2),
+            'schedule_skew_seconds': histogram_percentiles(
+                metrics_before, metrics_after, 'veggiecron_job_fire_lag_seconds'),
+            'db_writes_per_second': round(
+                (metrics_after.get(writes, 0) - metrics_before.get(writes, 0)) / elapsed, 2),
+            'api_latency_seconds': {
+                'create_job': percentiles(create_latencies),
+                'list_jobs': percentiles(list_latencies),
+            },
+            'peak_rss_mb': peak_rss,
+            'work_dir': self.work_dir,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the server and report JSON.')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--interval', type=int, default=5, help='Seconds between runs of a job.')
+    parser.add_argument('--clones', type=int, default=1, help='Requests made per run of a job.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to measure for, once the jobs are created.')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds the target takes to answer.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many more seconds the target takes to answer.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of target responses which are a 500.')
+    parser.add_argument('--shards', type=int, default=0, help='Scheduler worker processes.')
+    parser.add_argument('--backend', choices=('simple', 'curl'), default=None,
+                        help='HTTP client backend of the runner (defaults to config.yaml).')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='API requests in flight while seeding.')
+    parser.add_argument('--probe-interval', type=float, default=0.5,
+                        help='Seconds between job listings while measuring.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    AsyncIOMainLoop().install()
+    report = loop.run_until_complete(Benchmark(args).run())
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
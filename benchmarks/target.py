@@ -0,0 +1,93 @@
+"""
+benchmarks/target.py
+
+A stand-in HTTP target for the benchmarks. Every request is answered after `latency` seconds (plus
+up to `jitter` more), and `error_rate` of them get a 500. Run on its own with:
+
+    $ python3 -m benchmarks.target --port 8998 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import random
+
+from tornado.platform.asyncio import AsyncIOMainLoop
+from tornado.web import Application, RequestHandler
+
+
+class TargetHandler(RequestHandler):
+    """Answers every request to every path the same way."""
+
+    def initialize(self, latency: float, jitter: float, error_rate: float, rng: random.Random,
+                   counts: dict):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = rng
+        self.counts = counts
+
+    async def respond(self):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        self.counts['requests'] += 1
+        if self.rng.random() < self.error_rate:
+            self.counts['errors'] += 1
+            self.set_status(500)
+            self.write('error')
+        else:
+            self.write('ok')
+
+    async def get(self, *args):
+        await self.respond()
+
+    async def post(self, *args):
+        await self.respond()
+
+    async def put(self, *args):
+        await self.respond()
+
+    async def delete(self, *args):
+        await self.respond()
+
+
+class CountsHandler(RequestHandler):
+    """Reports how many requests were answered, and how many of them failed."""
+
+    def initialize(self, counts: dict):
+        self.counts = counts
+
+    def get(self):
+        self.write(self.counts)
+
+
+def make_app(latency: float = 0, jitter: float = 0, error_rate: float = 0, seed: int = 0):
+    """Create the target application."""
+    counts = {'requests': 0, 'errors': 0}
+    options = dict(latency=latency, jitter=jitter, error_rate=error_rate,
+                   rng=random.Random(seed), counts=counts)
+    return Application([
+        (r'/_counts', CountsHandler, dict(counts=counts)),
+        (r'/(.*)', TargetHandler, options),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in HTTP target for the benchmarks.')
+    parser.add_argument('--port', type=int, default=8998)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds before each response.')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Up to this many more seconds before each response.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests answered with a 500.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    AsyncIOMainLoop().install()
+    make_app(args.latency, args.jitter, args.error_rate, args.seed).listen(args.port)
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,5 @@
+from .blobs import ResultBlobs, latest_results
 from .connection import DB
+from .job_stats import JobStats, JobSummary
+from .leases import JobLeases
+from .retention import ResultRetention
@@ -0,0 +1,105 @@
+"""
+src/database/blobs.py
+
+Job results are stored as a small job_result row (status code and timing) pointing at the response
+body, which is compressed and stored once in the result_blob table under the SHA-256 of its text.
+Health checks which return the same body on every run add a row per run, but the body only once.
+"""
+
+import asyncio
+import hashlib
+import json
+import lzma
+import zlib
+
+from collections import OrderedDict
+
+from .connection import DB
+
+
+# Mapping of codec name -> (compress(bytes, level), decompress(bytes))
+codecs = {
+    'none': (lambda data, level: data, lambda data: data),
+    'zlib': (lambda data, level: zlib.compress(data, 6 if level is None else level),
+             zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+def decode(codec: str, data: bytes):
+    """Decompress the text of a blob."""
+    return codecs[codec][1](data).decode('utf8')
+
+
+async def latest_results(db: DB, job_id: int, limit: int = 25):
+    """The latest results of a job, newest first, as (result JSON, date created) pairs. The JSON is
+    the same as the runner produced, with the body put back in."""
+    rows = await db.execute('SELECT r.result, r.code, r.date_created, b.codec, b.data '
+                            'FROM job_result r LEFT JOIN result_blob b ON b.hash = r.blob_hash '
+                            'WHERE r.job_id = ? ORDER BY r.id DESC LIMIT ?', job_id, limit)
+    results = []
+    for result, code, date_created, codec, data in rows:
+
+        # Results stored before the blob table existed have no code, and the body inline
+        if code is not None:
+            result = json.loads(result)
+            result['code'] = code
+            if codec is not None:
+                result['body'] = decode(codec, data)
+            result = json.dumps(result)
+        results.append((result, date_created))
+    return results
+
+
+class ResultBlobs(object):
+    """Stores job results, compressing each distinct response body once."""
+
+    def __init__(self, db: DB, codec: str = 'zlib', level: int = None, cache_size: int = 256):
+        """Constructor."""
+        self.db = db
+        if codec not in codecs:
+            print('[ResultBlobs] Unknown codec "{}", using "zlib".'.format(codec))
+            codec = 'zlib'
+        self.codec = codec
+        self.level = level
+
+        # Mapping of hash -> compressed body for the latest distinct bodies, so a body returned over
+        # and over is hashed on every run but only compressed once
+        self.cache_size = cache_size
+        self._compressed = OrderedDict()
+
+    def encode(self, body: str):
+        """Hash and compress a body. Returns (hash, compressed body, size in bytes)."""
+        raw = body.encode('utf8')
+        hash_ = hashlib.sha256(raw).hexdigest()
+        data = self._compressed.get(hash_)
+        if data is None:
+            data = codecs[self.codec][0](raw, self.level)
+            self._compressed[hash_] = data
+            if len(self._compressed) > self.cache_size:
+                self._compressed.popitem(last=False)
+        else:
+            self._compressed.move_to_end(hash_)
+        return hash_, data, len(raw)
+
+    async def store(self, job_id: int, result: dict, date_created: float):
+        """Store the result of one request of a job run.
+
+        The rest of the result goes to job_result, and the body (if one was captured) to the blob
+        table unless it is there already. Both are ordinary batched writes, queued in that order:
+        once the row is committed, the retention task can't collect the blob as unused. A result
+        of a job deleted while it ran isn't stored (its body is collected as unused).
+        """
+        result = dict(result)
+        code = result.pop('code', 0)
+        body = result.pop('body', None)
+        hash_, data, size = self.encode(body) if body is not None else (None, None, 0)
+        writes = [self.db.execute('INSERT INTO job_result (job_id, result, code, blob_hash, '
+                                  'date_created) SELECT ?, ?, ?, ?, ? '
+                                  'WHERE EXISTS (SELECT 1 FROM job WHERE id = ?)',
+                                  job_id, json.dumps(result), code, hash_, date_created, job_id)]
+        if hash_ is not None:
+            writes.append(self.db.execute('INSERT OR IGNORE INTO result_blob (hash, codec, data, '
+                                          'size) VALUES (?, ?, ?, ?)',
+                                          hash_, self.codec, data, size))
+        await asyncio.gather(*writes)
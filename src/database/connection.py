@@ -1,51 +1,191 @@
 """
 src/database/connection.py
 
-One thread to handle all calls to the database. (and in the darkness bind them)
+One thread to handle all writes to the database (and in the darkness bind them), committing them in
+batches, and a pool of read-only connections so API reads are never stuck behind the writes.
 
 NOTE: I tried to get aioodbc working on my mac, but it was giving me too much hell. Would have been
       a much more elegant solution in my mind.
 """
 
 import asyncio
+import pathlib
 import sqlite3
+import threading
+import time
 
 from concurrent.futures import ThreadPoolExecutor
 
+from .migrate import migrate
+from .writer import Writer
 from ..utils.dates import now, utc_to_date, compare_utc_dates
+from ..utils.metrics import metrics
+
+
+query_seconds = metrics.histogram('veggiecron_db_query_seconds',
+                                  'Seconds taken by DB.execute, waiting included.', ('kind',))
+read_seconds = query_seconds.labels('read')
+write_seconds = query_seconds.labels('write')
+read_wait_seconds = metrics.histogram('veggiecron_db_read_wait_seconds',
+                                      'Seconds reads waited for a pooled connection.')
+reads_saturated = metrics.counter('veggiecron_db_reads_saturated',
+                                  'Reads which found every pooled connection busy.')
 
 
 class DB(object):
-    """Database connection in a single shared thread."""
+    """Database with one group-commit write thread and a pool of read-only connections."""
 
-    def __init__(self, database_file):
+    def __init__(self, database_file, commit_batch_size: int = 500, commit_window: float = 0.005,
+                 read_pool_size: int = 4, wal: bool = True):
         """Constructor."""
         self.database_file = database_file
-        self.db = sqlite3.connect(self.database_file, check_same_thread=False)
-        self.register_functions()
-        self.cur = self.db.cursor()
-        self._db_envoy = ThreadPoolExecutor(max_workers=1)
+        self.read_pool_size = read_pool_size
+
+        # Write statements are queued to the writer thread and committed in batches
+        self._writer = Writer(self.database_file, max_batch=commit_batch_size,
+                              commit_window=commit_window)
+
+        # Lets the retention task hand freed pages back to the file system a few at a time. Only
+        # takes effect on a new database, an existing one keeps its mode until it is vacuumed.
+        self._writer.db.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        if wal:
+            # WAL lets readers carry on while the writer commits, and only needs a full fsync at
+            # checkpoints when synchronous is NORMAL
+            self._writer.db.execute('PRAGMA journal_mode=WAL;')
+            self._writer.db.execute('PRAGMA synchronous=NORMAL;')
+        self.register_functions(self._writer.db)
+        self._writer.start()
+
+        # Reads run concurrently on a pool of threads, each with its own read-only connection
+        self._readers = threading.local()
+        self._reader_connections = []
+        self._db_envoy = ThreadPoolExecutor(max_workers=read_pool_size)
 
-    def register_functions(self):
-        """Register some utility functions to the database."""
+        # Read pool usage, for reporting saturation
+        self._pool_lock = threading.Lock()
+        self._reads_in_flight = 0
+        self._reads_max_waiting = 0
+
+        metrics.gauge('veggiecron_db_reads_in_flight',
+                      'Reads queued or running on the read pool.') \
+            .set_function(lambda: self._reads_in_flight)
+        metrics.gauge('veggiecron_db_reads_max_waiting',
+                      'Most reads seen waiting for a pooled connection at once.') \
+            .set_function(lambda: self._reads_max_waiting)
+        metrics.gauge('veggiecron_db_write_queue_depth', 'Writes waiting for the writer thread.') \
+            .set_function(self._writer.backlog)
+
+    @staticmethod
+    def register_functions(connection: sqlite3.Connection):
+        """Register some utility functions to a database connection."""
         def now_as_utc():
             return now(as_utc=True)
-        self.db.create_function('now_as_utc', 0, now_as_utc)
-        self.db.create_function('utc_to_date', 1, utc_to_date)
-        self.db.create_function('compare_utc_dates', 3, compare_utc_dates)
-        self.db.commit()
+        connection.create_function('now_as_utc', 0, now_as_utc)
+        connection.create_function('utc_to_date', 1, utc_to_date)
+        connection.create_function('compare_utc_dates', 3, compare_utc_dates)
+        connection.commit()
+
+    @staticmethod
+    def is_read(query: str):
+        """Does the query only read from the database?"""
+        return query.lstrip()[:6].upper() == 'SELECT'
+
+    def _connect_reader(self, pooled: bool = True):
+        """Open a read-only connection to the database."""
+        if self.database_file == ':memory:':
+            raise ValueError('The read pool cannot share an in-memory database.')
+        uri = pathlib.Path(self.database_file).absolute().as_uri() + '?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.register_functions(connection)
+        if pooled:
+            with self._pool_lock:
+                self._reader_connections.append(connection)
+        return connection
+
+    def _reader_cursor(self):
+        """The read pool thread's cursor, opened on first use."""
+        cur = getattr(self._readers, 'cur', None)
+        if cur is None:
+            cur = self._readers.cur = self._connect_reader().cursor()
+        return cur
+
+    def _read(self, query, args, submitted):
+        """Execute a read query and fetch all of its results. Runs on a read pool thread."""
+        read_wait_seconds.observe(time.monotonic() - submitted)
+        return self._reader_cursor().execute(query, args).fetchall()
 
     async def execute(self, query, *args):
-        """Execute the query and return all results."""
-        await asyncio.wrap_future(self._db_envoy.submit(self.cur.execute, query, args))
-        await asyncio.wrap_future(self._db_envoy.submit(self.db.commit))
-        return await asyncio.wrap_future(self._db_envoy.submit(self.cur.fetchall))
+        """Execute the query and return all results.
+
+        Reads are answered by the read pool. Writes resolve once the batch they were queued in has
+        been committed.
+        """
+        started = time.monotonic()
+        if not self.is_read(query):
+            try:
+                return await asyncio.wrap_future(self._writer.write(query, args))
+            finally:
+                write_seconds.observe(time.monotonic() - started)
+
+        with self._pool_lock:
+            self._reads_in_flight += 1
+            waiting = self._reads_in_flight - self.read_pool_size
+            if waiting > 0:
+                reads_saturated.inc()
+                self._reads_max_waiting = max(self._reads_max_waiting, waiting)
+        try:
+            return await asyncio.wrap_future(
+                self._db_envoy.submit(self._read, query, args, started))
+        finally:
+            with self._pool_lock:
+                self._reads_in_flight -= 1
+            read_seconds.observe(time.monotonic() - started)
+
+    async def stream(self, query, *args, chunk_size: int = 500):
+        """Yield the rows of a read query, fetching `chunk_size` rows at a time.
+
+        The query gets a connection of its own for as long as it is being read, so the whole result
+        never has to be held in memory and the pooled connections stay free for other reads.
+        """
+        def open_cursor():
+            connection_ = self._connect_reader(pooled=False)
+            return connection_, connection_.execute(query, args)
+
+        connection, cur = await asyncio.wrap_future(self._db_envoy.submit(open_cursor))
+        try:
+            while True:
+                rows = await asyncio.wrap_future(self._db_envoy.submit(cur.fetchmany, chunk_size))
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            self._db_envoy.submit(connection.close)
 
     async def executescript(self, script):
         """Execute a SQL script."""
-        return await asyncio.wrap_future(self._db_envoy.submit(self.cur.executescript, script))
+        def run_script(connection, script_):
+            return connection.executescript(script_)
+        return await self.run_in_writer(run_script, script)
+
+    async def run_in_reader(self, fn, *args):
+        """Run `fn(connection, *args)` on a read pool thread, with its read-only connection. For
+        work which takes many small queries, so they don't each make a trip through the loop."""
+        def run(fn_, args_):
+            return fn_(self._reader_cursor().connection, *args_)
+        return await asyncio.wrap_future(self._db_envoy.submit(run, fn, args))
+
+    async def run_in_writer(self, fn, *args):
+        """Run `fn(connection, *args)` on the writer thread, outside of any batched transaction."""
+        return await asyncio.wrap_future(self._writer.submit(fn, *args))
+
+    async def migrate(self):
+        """Apply every pending schema migration. Returns the names of the migrations applied."""
+        return await self.run_in_writer(migrate)
 
     def close(self):
-        """Close the connection to the database and the thread itself."""
-        self.db.close()
+        """Close the connections to the database and the threads themselves."""
         self._db_envoy.shutdown(wait=True)
+        for connection in self._reader_connections:
+            connection.close()
+        self._writer.close()
@@ -0,0 +1,196 @@
+"""
+src/database/job_stats.py
+
+Running totals of how each job's requests went: runs and failures, counts by status code, a latency
+sketch and the last error. The runner adds every request to an in-memory summary of its job, and
+the summaries are merged into the job_stats table every few seconds, one transaction for all of the
+jobs which ran. Reading a job's stats is then a single row, however long the job has been running.
+Several processes can run the same jobs, since each one merges what it saw into what is stored.
+"""
+
+import asyncio
+import json
+
+from .connection import DB
+from ..utils.dates import now
+from ..utils.sketch import QuantileSketch
+
+
+class JobSummary(object):
+    """Stats of one job."""
+
+    __slots__ = ('runs', 'failures', 'codes', 'sketch', 'elapsed_sum', 'elapsed_max',
+                 'last_error', 'last_error_code', 'last_error_at', 'last_run_at')
+
+    def __init__(self, runs: int = 0, failures: int = 0, codes: dict = None, sketch=None,
+                 elapsed_sum: float = 0.0, elapsed_max: float = None, last_error: str = None,
+                 last_error_code: int = None, last_error_at: float = None,
+                 last_run_at: float = None):
+        """Constructor."""
+        self.runs = runs
+        self.failures = failures
+
+        # Mapping of status code (0 for no response) -> number of requests
+        self.codes = codes or {}
+
+        # Seconds taken by the requests which were made
+        self.sketch = sketch or QuantileSketch()
+        self.elapsed_sum = elapsed_sum
+        self.elapsed_max = elapsed_max
+
+        self.last_error = last_error
+        self.last_error_code = last_error_code
+        self.last_error_at = last_error_at
+        self.last_run_at = last_run_at
+
+    @staticmethod
+    def is_failure(code: int):
+        """Did a request fail? (No response, or a 4xx or 5xx.)"""
+        return code == 0 or code >= 400
+
+    def record(self, result: dict, time_now: float):
+        """Add the result of one request of a run."""
+        code = result.get('code', 0)
+        self.runs += 1
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.last_run_at = time_now
+
+        # Requests which were never made (the host's circuit was open) have no latency
+        if 'error' not in result and result.get('elapsed') is not None:
+            self.sketch.add(result['elapsed'])
+            self.elapsed_sum += result['elapsed']
+            self.elapsed_max = max(self.elapsed_max or 0, result['elapsed'])
+
+        if self.is_failure(code):
+            self.failures += 1
+            self.last_error = (result.get('body') or '')[:500] if code == 0 else \
+                'HTTP {}'.format(code)
+            self.last_error_code = code
+            self.last_error_at = time_now
+
+    def merge(self, other):
+        """Add another summary of the same job to this one."""
+        self.runs += other.runs
+        self.failures += other.failures
+        for code, count in other.codes.items():
+            self.codes[code] = self.codes.get(code, 0) + count
+        self.sketch.merge(other.sketch)
+        self.elapsed_sum += other.elapsed_sum
+        if other.elapsed_max is not None:
+            self.elapsed_max = max(self.elapsed_max or 0, other.elapsed_max)
+        if other.last_error_at is not None and (self.last_error_at is None or
+                                                other.last_error_at >= self.last_error_at):
+            self.last_error = other.last_error
+            self.last_error_code = other.last_error_code
+            self.last_error_at = other.last_error_at
+        if other.last_run_at is not None:
+            self.last_run_at = max(self.last_run_at or 0, other.last_run_at)
+
+    def to_row(self, job_id: int):
+        """Values of the job's job_stats row."""
+        return (job_id, self.runs, self.failures,
+                json.dumps({str(code): count for code, count in self.codes.items()}),
+                json.dumps(self.sketch.to_dict()), self.elapsed_sum, self.elapsed_max,
+                self.last_error, self.last_error_code, self.last_error_at, self.last_run_at)
+
+    @classmethod
+    def from_row(cls, row):
+        """Summary from a job_stats row (as returned by to_row())."""
+        return cls(row[1], row[2], {int(code): count for code, count in json.loads(row[3]).items()},
+                   QuantileSketch.from_dict(json.loads(row[4])), *row[5:])
+
+    def to_dict(self):
+        """Public representation of the stats."""
+        timed = self.sketch.count
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'success_rate': round(1 - self.failures / self.runs, 6) if self.runs else None,
+            'codes': {str(code): count for code, count in sorted(self.codes.items())},
+            'latency': {
+                'mean': round(self.elapsed_sum / timed, 6) if timed else None,
+                'p50': self.rounded(self.sketch.quantile(0.5)),
+                'p90': self.rounded(self.sketch.quantile(0.9)),
+                'p99': self.rounded(self.sketch.quantile(0.99)),
+                'max': self.elapsed_max,
+            },
+            'last_error': None if self.last_error_at is None else {
+                'code': self.last_error_code,
+                'message': self.last_error,
+                'timestamp': self.last_error_at,
+            },
+            'last_run_at': self.last_run_at,
+        }
+
+    @staticmethod
+    def rounded(value):
+        return round(value, 6) if value is not None else None
+
+
+class JobStats(object):
+    """In-memory stats of the jobs run by this process, merged into the database periodically.
+
+    Whatever was recorded since the last merge is lost if the process stops.
+    """
+
+    # Most jobs looked up by one "IN (...)" query, well under SQLite's limit on parameters
+    lookup_chunk_size = 500
+
+    def __init__(self, db: DB, flush_interval: float = 10):
+        """Constructor."""
+        self.db = db
+        self.flush_interval = flush_interval
+
+        # Mapping of job id -> JobSummary of the requests since the last merge
+        self._pending = {}
+
+    def record(self, job_id: int, result: dict):
+        """Add the result of one request of a job run."""
+        summary = self._pending.get(job_id)
+        if summary is None:
+            summary = self._pending[job_id] = JobSummary()
+        summary.record(result, now(as_utc=True))
+
+    def start(self):
+        """Merge the stats into the database every `flush_interval` seconds."""
+        asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print('[JobStats] Could not save job stats: {!r}'.format(e))
+
+    async def flush(self):
+        """Merge the stats recorded since the last merge into the database."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        await self.db.run_in_writer(self.merge_rows, pending)
+
+    def merge_rows(self, connection, pending: dict):
+        """Merge summaries into the job_stats table, in one transaction on the writer thread."""
+        job_ids = list(pending)
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            for start in range(0, len(job_ids), self.lookup_chunk_size):
+                chunk = job_ids[start:start + self.lookup_chunk_size]
+                for row in connection.execute('SELECT * FROM job_stats WHERE job_id IN ({});'
+                                              .format(', '.join('?' * len(chunk))), chunk):
+                    stored = JobSummary.from_row(row)
+                    stored.merge(pending[row[0]])
+                    pending[row[0]] = stored
+
+            # Only jobs which still exist, in case one was deleted since it ran
+            connection.executemany(
+                'INSERT OR REPLACE INTO job_stats (job_id, runs, failures, codes, sketch, '
+                'elapsed_sum, elapsed_max, last_error, last_error_code, last_error_at, '
+                'last_run_at) SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? '
+                'WHERE EXISTS (SELECT 1 FROM job WHERE id = ?);',
+                [summary.to_row(job_id) + (job_id,) for job_id, summary in pending.items()])
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
@@ -0,0 +1,71 @@
+"""
+src/database/leases.py
+
+Leases on jobs, so several scheduler processes can share one database. Before a run is fired its job
+is claimed: the lease is taken atomically, and only if no live scheduler holds it and nobody has run
+the job since it was scheduled. The lease is renewed while the run is in flight and given back when
+the run is recorded. A scheduler which dies leaves its leases to expire, and the runs they covered
+are then fired by whoever claims them next.
+"""
+
+import os
+import socket
+import uuid
+
+from .connection import DB
+
+
+class JobLeases(object):
+    """Takes, renews and gives back the leases of one scheduler."""
+
+    def __init__(self, db: DB, lease_seconds: float = 60, owner: str = None):
+        """Constructor."""
+        self.db = db
+        self.lease_seconds = lease_seconds
+
+        # Unique to this scheduler, including across restarts of the same process id
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                                uuid.uuid4().hex[:8])
+
+    async def claim(self, runs, time_now: float):
+        """Take the lease on each job in `runs`, a list of (job id, last ran) pairs.
+
+        A job is claimed when it isn't done or paused, its lease is free, expired or already ours,
+        and its last run is still the one the run was scheduled from. Returns the set of job ids
+        claimed.
+        """
+        expires = time_now + self.lease_seconds
+
+        def claim_runs(connection, runs_):
+            claimed = set()
+            for job_id, last_ran in runs_:
+                # Compared column by column (not through COALESCE) so the timestamps, which are
+                # stored as text, are matched exactly
+                cur = connection.execute(
+                    'UPDATE job SET lease_owner = ?, lease_expires = ? '
+                    'WHERE id = ? AND done = 0 AND paused = 0 '
+                    'AND (last_ran = ? OR (last_ran IS NULL AND date_created = ?)) '
+                    'AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?);',
+                    (self.owner, expires, job_id, last_ran, last_ran, self.owner, time_now))
+                if cur.rowcount:
+                    claimed.add(job_id)
+            connection.commit()
+            return claimed
+
+        return await self.db.run_in_writer(claim_runs, list(runs))
+
+    async def renew(self, time_now: float):
+        """Push back the expiry of every lease held by this scheduler."""
+        await self.db.execute('UPDATE job SET lease_expires = ? WHERE lease_owner = ?;',
+                              time_now + self.lease_seconds, self.owner)
+
+    async def release(self, job_id: int):
+        """Give back the lease on a job, without recording a run."""
+        await self.db.execute('UPDATE job SET lease_owner = NULL, lease_expires = NULL '
+                              'WHERE id = ? AND lease_owner = ?;', job_id, self.owner)
+
+    async def count_expired(self, time_now: float):
+        """Number of jobs whose lease ran out, i.e. runs cut short by a scheduler going down."""
+        rows = await self.db.execute('SELECT COUNT(*) FROM job WHERE lease_owner IS NOT NULL '
+                                     'AND lease_expires < ?;', time_now)
+        return rows[0][0]
@@ -0,0 +1,76 @@
+"""
+src/database/migrate.py
+
+Versioned schema migrations. Every module in src/database/migrations named "<version>_<name>.py"
+provides an `upgrade(connection)` function. Migrations newer than the version recorded in the
+schema_version table are applied in order at startup, each in its own transaction (which a
+migration must not commit).
+"""
+
+import importlib
+import os
+import re
+import sqlite3
+
+from ..utils.dates import now
+
+
+migrations_dir = os.path.join(os.path.dirname(__file__), 'migrations')
+migration_file = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+
+def find_migrations():
+    """List every migration as (version, name, module path), in order."""
+    migrations = []
+    for file_name in os.listdir(migrations_dir):
+        match = migration_file.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                               '{}.migrations.{}'.format(__package__, file_name[:-3])))
+    return sorted(migrations)
+
+
+def current_version(connection: sqlite3.Connection):
+    """Version of the latest migration applied to the database."""
+    connection.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, '
+                       'name TEXT NOT NULL, date_applied TEXT NOT NULL);')
+    connection.commit()
+    return applied_version(connection)
+
+
+def applied_version(connection: sqlite3.Connection):
+    """Latest version recorded in the schema_version table, or 0."""
+    version = connection.execute('SELECT MAX(version) FROM schema_version;').fetchone()[0]
+    return version or 0
+
+
+def migrate(connection: sqlite3.Connection):
+    """Apply every pending migration. Returns the names of the migrations applied.
+
+    Each migration takes the write lock before checking whether it is still pending, so several
+    servers starting at once on the same database apply it once, one after another.
+    """
+    applied = []
+    version = current_version(connection)
+    for migration_version, name, module_path in find_migrations():
+        if migration_version <= version:
+            continue
+        module = importlib.import_module(module_path)
+        try:
+            connection.execute('BEGIN IMMEDIATE;')
+
+            # Another server may have applied it while this one waited for the lock
+            version = applied_version(connection)
+            if migration_version <= version:
+                connection.rollback()
+                continue
+
+            module.upgrade(connection)
+            connection.execute('INSERT INTO schema_version (version, name, date_applied) '
+                               'VALUES (?, ?, ?);', (migration_version, name, now(as_utc=True)))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        applied.append('{:04d}_{}'.format(migration_version, name))
+    return applied
@@ -0,0 +1,39 @@
+"""
+src/database/migrations/0001_initial_schema.py
+
+Generate the original schema (src/database/sql/schema.sql) if the database is empty.
+"""
+
+import os
+import sqlite3
+
+
+schema_file = os.path.join(os.path.dirname(__file__), '..', 'sql', 'schema.sql')
+
+
+def split_statements(script: str):
+    """Split an SQL script into its statements."""
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
+
+
+def upgrade(connection: sqlite3.Connection):
+    tables = connection.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                "AND name != 'schema_version';").fetchall()
+    if len(tables) == 0:
+        print('No tables found in database. Generating schema..')
+        with open(schema_file, 'r') as f:
+            script = f.read()
+
+        # One statement at a time, as executescript() would commit the migration's transaction
+        for statement in split_statements(script):
+            connection.execute(statement)
+        print('Schema generated successfully.')
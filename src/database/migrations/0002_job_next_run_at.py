@@ -0,0 +1,16 @@
+"""
+src/database/migrations/0002_job_next_run_at.py
+
+Store every job's next run time, indexed so the scheduler can load the jobs which are due soon.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    columns = connection.execute("SELECT name FROM pragma_table_info('job');").fetchall()
+    if ('next_run_at',) not in columns:
+        connection.execute('ALTER TABLE job ADD COLUMN next_run_at REAL;')
+
+    # Also serves "WHERE done = 0" on its own
+    connection.execute('CREATE INDEX IF NOT EXISTS job_next_run_at ON job (done, next_run_at);')
@@ -0,0 +1,16 @@
+"""
+src/database/migrations/0003_hot_path_indexes.py
+
+Indexes for the queries run on every API call and every job run.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+
+    # "SELECT ... FROM job_result WHERE job_id = ? ORDER BY id DESC LIMIT 25"
+    connection.execute('CREATE INDEX IF NOT EXISTS job_result_job_id ON job_result (job_id, id);')
+
+    # "SELECT * FROM user WHERE username = ?" and "... WHERE username = ? AND token = ?"
+    connection.execute('CREATE INDEX IF NOT EXISTS user_username ON user (username);')
@@ -0,0 +1,13 @@
+"""
+src/database/migrations/0004_job_user_id_index.py
+
+Index for listing a user's jobs page by page.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+
+    # "SELECT * FROM job WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?"
+    connection.execute('CREATE INDEX IF NOT EXISTS job_user_id ON job (user_id, id);')
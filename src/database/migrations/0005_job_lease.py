@@ -0,0 +1,20 @@
+"""
+src/database/migrations/0005_job_lease.py
+
+Lease columns on jobs. A scheduler takes the lease on a job before firing it and gives it back once
+the run is recorded, so schedulers sharing the database never fire the same run twice.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    columns = connection.execute("SELECT name FROM pragma_table_info('job');").fetchall()
+    if ('lease_owner',) not in columns:
+        connection.execute('ALTER TABLE job ADD COLUMN lease_owner TEXT;')
+    if ('lease_expires',) not in columns:
+        connection.execute('ALTER TABLE job ADD COLUMN lease_expires REAL;')
+
+    # "UPDATE job SET lease_expires = ? WHERE lease_owner = ?", only ever over the jobs running now
+    connection.execute('CREATE INDEX IF NOT EXISTS job_lease_owner ON job (lease_owner) '
+                       'WHERE lease_owner IS NOT NULL;')
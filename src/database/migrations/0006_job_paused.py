@@ -0,0 +1,13 @@
+"""
+src/database/migrations/0006_job_paused.py
+
+Jobs can be paused. A paused job keeps its schedule but is not loaded or fired until it is resumed.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    columns = connection.execute("SELECT name FROM pragma_table_info('job');").fetchall()
+    if ('paused',) not in columns:
+        connection.execute('ALTER TABLE job ADD COLUMN paused INTEGER NOT NULL DEFAULT 0;')
@@ -0,0 +1,19 @@
+"""
+src/database/migrations/0007_result_blobs.py
+
+Response bodies are stored compressed in their own table, once per distinct body, and job results
+point at them by hash. Results stored before this keep their body inline in job_result.result.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS result_blob (hash TEXT PRIMARY KEY, '
+                       'codec TEXT NOT NULL, data BLOB NOT NULL, size INTEGER NOT NULL);')
+
+    columns = connection.execute("SELECT name FROM pragma_table_info('job_result');").fetchall()
+    if ('code',) not in columns:
+        connection.execute('ALTER TABLE job_result ADD COLUMN code INTEGER;')
+    if ('blob_hash',) not in columns:
+        connection.execute('ALTER TABLE job_result ADD COLUMN blob_hash TEXT;')
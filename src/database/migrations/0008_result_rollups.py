@@ -0,0 +1,25 @@
+"""
+src/database/migrations/0008_result_rollups.py
+
+Job results past their retention are folded into hourly (and later daily) rollups before they are
+deleted, so a job's history is kept as counts and latencies per status code.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS job_result_rollup (id INTEGER PRIMARY KEY, '
+                       'job_id INTEGER NOT NULL, period TEXT NOT NULL, period_start REAL NOT NULL, '
+                       'code INTEGER NOT NULL, count INTEGER NOT NULL, elapsed_sum REAL NOT NULL, '
+                       'elapsed_min REAL, elapsed_max REAL);')
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS job_result_rollup_key '
+                       'ON job_result_rollup (job_id, period, period_start, code);')
+
+    # "... WHERE period = 'hour' AND period_start < ?", when hourly rollups are folded into days
+    connection.execute('CREATE INDEX IF NOT EXISTS job_result_rollup_period '
+                       'ON job_result_rollup (period, period_start);')
+
+    # Finding the blobs no result points at any more
+    connection.execute('CREATE INDEX IF NOT EXISTS job_result_blob_hash ON job_result (blob_hash) '
+                       'WHERE blob_hash IS NOT NULL;')
@@ -0,0 +1,16 @@
+"""
+src/database/migrations/0009_job_stats.py
+
+Running stats of each job's requests (counts by status code, a latency sketch and the last error),
+so a job's health is read from one row instead of its whole result history.
+"""
+
+import sqlite3
+
+
+def upgrade(connection: sqlite3.Connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS job_stats (job_id INTEGER PRIMARY KEY, '
+                       'runs INTEGER NOT NULL, failures INTEGER NOT NULL, codes TEXT NOT NULL, '
+                       'sketch TEXT NOT NULL, elapsed_sum REAL NOT NULL, elapsed_max REAL, '
+                       'last_error TEXT, last_error_code INTEGER, last_error_at REAL, '
+                       'last_run_at REAL, FOREIGN KEY(job_id) REFERENCES job(id));')
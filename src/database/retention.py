@@ -0,0 +1,332 @@
+"""
+src/database/retention.py
+
+Background upkeep of job results, so the database stops growing once jobs have been running for a
+while. Every few minutes the results each job is no longer keeping (past its latest N, or older
+than D days) are folded into hourly rollups (runs, and latency, per status code) and deleted, a
+batch at a time. Old hourly rollups are folded into daily ones, response bodies no result points at
+any more are deleted, and the freed pages are handed back to the file system with an incremental
+vacuum.
+"""
+
+import asyncio
+import json
+import time
+
+from .connection import DB
+from ..utils.dates import local_time, local_timestamp, now
+
+
+class ResultRetention(object):
+    """Enforces the retention of job results and keeps the rollups of what it deletes.
+
+    A result is let go once it is no longer among its job's latest `keep_results`, or is older than
+    `keep_days` days (0 turns either limit off). `users` maps usernames to their own "keep_results"
+    and "keep_days", and a job's data may hold its own as well.
+    """
+
+    def __init__(self, db: DB, keep_results: int = 1000, keep_days: float = 30,
+                 hourly_days: float = 30, interval: float = 300, batch_size: int = 500,
+                 vacuum_pages: int = 1000, users: dict = None):
+        """Constructor."""
+        self.db = db
+        self.keep_results = keep_results
+        self.keep_days = keep_days
+
+        # Hourly rollups older than this many days are folded into daily ones
+        self.hourly_days = hourly_days
+
+        # Seconds between passes
+        self.interval = interval
+
+        # Most rows deleted in one transaction, so other writes are never held up for long
+        self.batch_size = batch_size
+
+        # Most free pages handed back to the file system after each pass
+        self.vacuum_pages = vacuum_pages
+
+        # Mapping of username -> {"keep_results": N, "keep_days": D}
+        self.users = users or {}
+
+        # Results up to this id have been checked against their job's "keep_results". Only jobs
+        # with newer results can have gone over it since.
+        self._checked_id = 0
+
+    @classmethod
+    def from_config(cls, server_config, db: DB):
+        """Create the retention task from the server config."""
+        return cls(db, server_config.retention_keep_results, server_config.retention_keep_days,
+                   server_config.retention_hourly_days, server_config.retention_interval,
+                   server_config.retention_batch_size, server_config.retention_vacuum_pages,
+                   server_config.retention_users)
+
+    def start(self):
+        """Run the passes in the background."""
+        asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Run a pass every `interval` seconds. A failed pass is logged and tried again later."""
+        if not await self.db.run_in_writer(self.incremental_vacuum_enabled):
+            self << 'The database was created without incremental vacuum, so space freed by ' \
+                    'deleted results is reused but not given back. Run "PRAGMA ' \
+                    'auto_vacuum=INCREMENTAL; VACUUM;" on it once (offline) to turn it on.'
+        while True:
+            try:
+                await self.run_pass()
+            except Exception as e:
+                self << 'Pass failed: {!r}'.format(e)
+            await asyncio.sleep(self.interval)
+
+    async def run_pass(self):
+        """Expire, roll up and delete old results, then reclaim the space they used.
+
+        The jobs are looked at `batch_size` at a time, each batch in its own short read, and the
+        results a batch finds expired are deleted before the next batch is read.
+        """
+        started = time.monotonic()
+        time_now = now(as_utc=True)
+        newest, active = await self.db.run_in_reader(self.find_active, self._checked_id)
+        by_age = {}
+        expired = 0
+        after = 0
+        while after is not None:
+            work, after = await self.db.run_in_reader(self.find_expired, after, time_now, active,
+                                                      by_age)
+            while work:
+                count, work = await self.db.run_in_writer(self.expire_batch, work)
+                expired += count
+        self._checked_id = newest
+
+        folded = 1
+        while folded:
+            folded = await self.db.run_in_writer(self.fold_hours_batch,
+                                                 now(as_utc=True) - self.hourly_days * 86400)
+
+        blobs = 0
+        after = ''
+        while after is not None:
+            count, after = await self.db.run_in_writer(self.collect_blobs_batch, after)
+            blobs += count
+
+        await self.db.run_in_writer(self.incremental_vacuum)
+        if expired or blobs:
+            self << 'Rolled up {} results and deleted {} unused bodies in {:.2f} seconds.'.format(
+                expired, blobs, time.monotonic() - started)
+
+    def limits(self, username: str, keep_results, keep_days):
+        """The retention of a job: its own data first, then its user's, then the defaults."""
+        user = self.users.get(username) or {}
+        try:
+            keep_results = int(keep_results if keep_results is not None else
+                               user.get('keep_results', self.keep_results))
+            keep_days = float(keep_days if keep_days is not None else
+                              user.get('keep_days', self.keep_days))
+        except (TypeError, ValueError):
+            keep_results, keep_days = self.keep_results, self.keep_days
+        return max(0, keep_results), max(0, keep_days)
+
+    @staticmethod
+    def id_before(connection, cutoff: float):
+        """Id of the last result created before a time, or 0.
+
+        Ids and creation times go up together, so this is a binary search on the primary key rather
+        than a scan of the table.
+        """
+        low, high = connection.execute('SELECT MIN(id), MAX(id) FROM job_result;').fetchone()
+        found = 0
+        while low is not None and low <= high:
+            middle = (low + high) // 2
+            row = connection.execute('SELECT id, date_created FROM job_result WHERE id >= ? '
+                                     'ORDER BY id LIMIT 1;', (middle,)).fetchone()
+            if float(row[1]) < cutoff:
+                found = row[0]
+                low = row[0] + 1
+            else:
+                high = middle - 1
+        return found
+
+    @staticmethod
+    def find_active(connection, checked_id: int):
+        """Jobs with results newer than `checked_id` (or None, meaning every job, when nothing has
+        been checked yet). Runs on a read pool thread. Returns the newest result id, and the jobs.
+        """
+        newest = connection.execute('SELECT MAX(id) FROM job_result;').fetchone()[0] or 0
+        if not checked_id:
+            return newest, None
+        return newest, {row[0] for row in connection.execute(
+            'SELECT DISTINCT job_id FROM job_result WHERE id > ? AND id <= ?;',
+            (checked_id, newest))}
+
+    def find_expired(self, connection, after: int, time_now: float, active, by_age: dict):
+        """The next `batch_size` jobs (by id) after `after` with results past their retention. Runs
+        on a read pool thread.
+
+        Only the jobs in `active` (every job if it is None) are checked against "keep_results".
+        `by_age` maps keep_days -> id of the last result older than that, filled in as it is needed
+        and kept for the rest of the pass.
+
+        Returns a list of (job id, id of the job's newest expired result), and the job id to carry
+        on from or None once every job has been looked at.
+        """
+        jobs = connection.execute(
+            "SELECT j.id, u.username, json_extract(j.data, '$.keep_results'), "
+            "json_extract(j.data, '$.keep_days') FROM job j JOIN user u ON u.id = j.user_id "
+            "WHERE j.id > ? ORDER BY j.id LIMIT ?;", (after, self.batch_size)).fetchall()
+
+        work = []
+        for job_id, username, keep_results, keep_days in jobs:
+            keep_results, keep_days = self.limits(username, keep_results, keep_days)
+            last_expired = 0
+            if keep_results and (active is None or job_id in active):
+                row = connection.execute('SELECT id FROM job_result WHERE job_id = ? '
+                                         'ORDER BY id DESC LIMIT 1 OFFSET ?;',
+                                         (job_id, keep_results)).fetchone()
+                if row is not None:
+                    last_expired = row[0]
+            if keep_days:
+                if keep_days not in by_age:
+                    by_age[keep_days] = self.id_before(connection, time_now - keep_days * 86400)
+                last_expired = max(last_expired, by_age[keep_days])
+            if last_expired and connection.execute(
+                    'SELECT 1 FROM job_result WHERE job_id = ? AND id <= ? LIMIT 1;',
+                    (job_id, last_expired)).fetchone():
+                work.append((job_id, last_expired))
+        return work, jobs[-1][0] if len(jobs) == self.batch_size else None
+
+    @staticmethod
+    def period_start(period: str, timestamp: float):
+        """Start of the (local) hour or day a time falls in."""
+        day, seconds = local_time(timestamp)
+        if period == 'hour':
+            return timestamp - seconds % 3600
+        return local_timestamp(day.year, day.month, day.day)
+
+    @staticmethod
+    def add_to_rollups(connection, rollups: dict):
+        """Add counts and latencies to the rollup rows, creating those which don't exist yet.
+
+        `rollups` maps (job id, period, period start, code) -> [count, elapsed sum, elapsed min,
+        elapsed max].
+        """
+        for (job_id, period, period_start, code), (count, total, low, high) in rollups.items():
+            cur = connection.execute(
+                'UPDATE job_result_rollup SET count = count + ?, elapsed_sum = elapsed_sum + ?, '
+                'elapsed_min = COALESCE(MIN(elapsed_min, ?), elapsed_min, ?), '
+                'elapsed_max = COALESCE(MAX(elapsed_max, ?), elapsed_max, ?) '
+                'WHERE job_id = ? AND period = ? AND period_start = ? AND code = ?;',
+                (count, total, low, low, high, high, job_id, period, period_start, code))
+            if not cur.rowcount:
+                connection.execute(
+                    'INSERT INTO job_result_rollup (job_id, period, period_start, code, count, '
+                    'elapsed_sum, elapsed_min, elapsed_max) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                    (job_id, period, period_start, code, count, total, low, high))
+
+    @staticmethod
+    def fold(rollups: dict, key, count: int, total: float, low, high):
+        """Add to one rollup in memory. Results without a recorded time only add to the count."""
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollups[key] = [count, total, low, high]
+            return
+        rollup[0] += count
+        rollup[1] += total
+        if low is not None:
+            rollup[2] = low if rollup[2] is None else min(rollup[2], low)
+        if high is not None:
+            rollup[3] = high if rollup[3] is None else max(rollup[3], high)
+
+    def expire_batch(self, connection, work):
+        """Roll up and delete up to `batch_size` expired results, in one transaction on the writer
+        thread. Returns the number of results deleted and the work left to do."""
+        work = list(work)
+        rollups = {}
+        deleted = 0
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            while work and deleted < self.batch_size:
+                job_id, last_expired = work[-1]
+                limit = self.batch_size - deleted
+                rows = connection.execute(
+                    'SELECT id, code, result, date_created FROM job_result '
+                    'WHERE job_id = ? AND id <= ? ORDER BY id LIMIT ?;',
+                    (job_id, last_expired, limit)).fetchall()
+                for _, code, result, date_created in rows:
+                    try:
+                        result = json.loads(result) if result else {}
+                    except ValueError:
+                        result = {}
+
+                    # Results stored before the blob table existed have their code in the JSON
+                    if code is None:
+                        code = result.get('code', 0)
+                    elapsed = result.get('elapsed')
+                    key = (job_id, 'hour', self.period_start('hour', float(date_created)), code)
+                    self.fold(rollups, key, 1, elapsed or 0, elapsed, elapsed)
+                if rows:
+                    connection.execute('DELETE FROM job_result WHERE job_id = ? AND id <= ?;',
+                                       (job_id, rows[-1][0]))
+                deleted += len(rows)
+                if len(rows) < limit:
+                    work.pop()
+            self.add_to_rollups(connection, rollups)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return deleted, work
+
+    def fold_hours_batch(self, connection, cutoff: float):
+        """Fold up to `batch_size` hourly rollups from before `cutoff` into daily ones, in one
+        transaction on the writer thread. Returns the number folded."""
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            rows = connection.execute(
+                "SELECT id, job_id, period_start, code, count, elapsed_sum, elapsed_min, "
+                "elapsed_max FROM job_result_rollup WHERE period = 'hour' AND period_start < ? "
+                "LIMIT ?;", (cutoff, self.batch_size)).fetchall()
+            rollups = {}
+            for _, job_id, period_start, code, count, total, low, high in rows:
+                self.fold(rollups, (job_id, 'day', self.period_start('day', period_start), code),
+                          count, total, low, high)
+            connection.executemany('DELETE FROM job_result_rollup WHERE id = ?;',
+                                   [(row[0],) for row in rows])
+            self.add_to_rollups(connection, rollups)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return len(rows)
+
+    def collect_blobs_batch(self, connection, after: str):
+        """Delete the unused bodies among the next `batch_size` blobs (by hash) after `after`, in
+        one transaction on the writer thread. Returns the number deleted, and the hash to carry on
+        from or None once every blob has been looked at."""
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            hashes = [row[0] for row in connection.execute(
+                'SELECT hash FROM result_blob WHERE hash > ? ORDER BY hash LIMIT ?;',
+                (after, self.batch_size))]
+            unused = [(hash_,) for hash_ in hashes if not connection.execute(
+                'SELECT 1 FROM job_result WHERE blob_hash = ? LIMIT 1;', (hash_,)).fetchone()]
+            connection.executemany('DELETE FROM result_blob WHERE hash = ?;', unused)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return len(unused), hashes[-1] if len(hashes) == self.batch_size else None
+
+    @staticmethod
+    def incremental_vacuum_enabled(connection):
+        """Was the database created with incremental vacuum on?"""
+        return connection.execute('PRAGMA auto_vacuum;').fetchone()[0] == 2
+
+    def incremental_vacuum(self, connection):
+        """Hand up to `vacuum_pages` free pages back to the file system."""
+        if self.vacuum_pages and self.incremental_vacuum_enabled(connection):
+            # Run as a script, which steps the pragma until it is done
+            connection.executescript('PRAGMA incremental_vacuum({:d});'.format(self.vacuum_pages))
+
+    def __lshift__(self, msg):
+        """Helper function for printing a message."""
+        msg = '[ResultRetention] ' + msg
+        print(msg)
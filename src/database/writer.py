@@ -0,0 +1,142 @@
+"""
+src/database/writer.py
+
+One thread which owns the write connection to the database. Write statements are queued up and
+committed together in batched transactions (group commit), so a burst of thousands of writes costs a
+handful of commits instead of one fsync per statement.
+"""
+
+import queue
+import sqlite3
+import time
+
+from concurrent.futures import Future
+from threading import Thread
+
+
+# Sent to the queue to stop the writer thread
+_STOP = object()
+
+
+class Writer(Thread):
+    """A separate thread which executes queued write statements and commits them in batches."""
+
+    def __init__(self, database_file, max_batch: int = 500, commit_window: float = 0.005):
+        """Constructor."""
+
+        # Maximum number of statements committed in a single transaction
+        self.max_batch = max_batch
+
+        # Number of seconds to wait for more statements before committing a batch
+        self.commit_window = commit_window
+
+        # The write connection is only ever used from this thread
+        self.db = sqlite3.connect(database_file, check_same_thread=False)
+        self.cur = self.db.cursor()
+
+        # Work items are tuples of (function, args, future, exclusive)
+        self._queue = queue.Queue()
+
+        # Call the parent (Thread) constructor
+        super().__init__(name='Thread-DBWriter', daemon=True)
+
+    def write(self, query, args) -> Future:
+        """Queue a write statement. The future resolves with its rows once the batch is
+        committed."""
+        future = Future()
+        self._queue.put((self._execute, (query, args), future, False))
+        return future
+
+    def submit(self, fn, *args) -> Future:
+        """Run `fn(connection, *args)` on the writer thread on its own, outside of any batch.
+
+        Used for anything that has to manage its own transaction, such as SQL scripts.
+        """
+        future = Future()
+        self._queue.put((fn, (self.db,) + args, future, True))
+        return future
+
+    def backlog(self):
+        """Number of work items waiting to be run."""
+        return self._queue.qsize()
+
+    def run(self):
+        """Main function of this thread."""
+        pending = None
+        while True:
+            item = pending if pending is not None else self._queue.get()
+            pending = None
+
+            # If "_STOP" is sent to the queue, end the thread
+            if item is _STOP:
+                break
+
+            if item[3]:
+                self._run_exclusive(item)
+                continue
+
+            # Gather up statements until the batch is full or the commit window closes
+            batch = [item]
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                # Exclusive work (and the stop signal) wait until the batch is committed
+                if item is _STOP or item[3]:
+                    pending = item
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+    def _execute(self, query, args):
+        """Execute a single statement and return any resulting rows."""
+        return self.cur.execute(query, args).fetchall()
+
+    def _commit(self, batch):
+        """Execute every statement in the batch and commit them in one transaction."""
+        results = []
+        for fn, args, future, _ in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # A failing statement is rolled back on its own by SQLite, the rest of the batch stands
+            try:
+                results.append((future, fn(*args), None))
+            except Exception as e:
+                results.append((future, None, e))
+
+        try:
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            results = [(future, None, e) for future, _, _ in results]
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _run_exclusive(self, item):
+        """Run a function which manages its own transaction."""
+        fn, args, future, _ = item
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            self.db.rollback()
+            future.set_exception(e)
+
+    def close(self):
+        """Commit everything still queued, then stop the thread and close the connection."""
+        self._queue.put(_STOP)
+        self.join()
+        self.db.close()
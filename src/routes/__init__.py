@@ -2,3 +2,6 @@ from .index import IndexPageHandler
 from .register import RegisterPageHandler
 from .login import LoginPageHandler
 from .job import JobPageHandler
+from .job_bulk import JobBulkPageHandler
+from .job_stats import JobStatsPageHandler
+from .metrics import MetricsPageHandler
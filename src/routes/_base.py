@@ -6,7 +6,7 @@ Base route for which all other routes should inherit from.
 
 from tornado.web import RequestHandler
 
-from ..scheduler import JobScheduler
+from ..scheduler import JobScheduler, JobRunnerRegistry
 
 
 class BasePageHandler(RequestHandler):
@@ -24,6 +24,10 @@ class BasePageHandler(RequestHandler):
     def scheduler(self) -> JobScheduler:
         return self.application.scheduler
 
+    @property
+    def registry(self) -> JobRunnerRegistry:
+        return self.application.registry
+
     async def get_cursor(self):
         return await self.application.db.cursor()
 
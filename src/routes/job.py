@@ -4,15 +4,52 @@ src/routes/job.py
 Job "/job" route for all HTTP methods.
 """
 
+import json
+
 from tornado.web import HTTPError
 
 from ._base import BasePageHandler
-from ..scheduler import Job
+from ..database import latest_results
+from ..scheduler import Job, compile_schedule, ParseError, JobDataError
 from ..utils.dates import utc_to_date, now
 
 
 class JobPageHandler(BasePageHandler):
 
+    # Number of jobs listed per page, unless "limit" says otherwise
+    default_page_size = 100
+    max_page_size = 1000
+
+    # Number of jobs written between each flush when streaming
+    stream_chunk_size = 500
+
+    @staticmethod
+    def job_to_dict(job, job_types):
+        """Public representation of a job table row."""
+        return {
+            'name': job[2],
+            'type': job_types[job[3]].name,
+            'data': job[4],
+            'schedule': job[5],
+            'last_ran': job[7],
+            'done': True if job[6] == 1 else False,
+            'paused': True if job[13] == 1 else False,
+        }
+
+    async def stream_jobs(self, user_id, after, limit, job_types):
+        """Write the user's jobs as newline delimited JSON, flushing every few hundred jobs. Every
+        job is written unless `limit` is set."""
+        self.set_header('Content-Type', 'application/x-ndjson')
+        rows = self.db.stream("SELECT * FROM job WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?;",
+                              user_id, after, limit if limit is not None else -1,
+                              chunk_size=self.stream_chunk_size)
+        count = 0
+        async for job in rows:
+            self.write(json.dumps(self.job_to_dict(job, job_types)) + '\n')
+            count += 1
+            if count % self.stream_chunk_size == 0:
+                await self.flush()
+
     async def get(self):
         # Check for auth token
         auth_token = self.request.headers.get('X-Auth-Token', None)
@@ -21,24 +58,38 @@ class JobPageHandler(BasePageHandler):
         job_name = self.get_query_argument('name', None)
         if job_name is None:
 
-            # Get all jobs for user
-            jobs = await self.db.execute("SELECT * FROM job WHERE user_id = ?;", user_id)
-            job_types = await self.db.execute("SELECT id, name FROM job_type;")
-            job_types = {k: v for k, v in job_types}
+            # Jobs are listed in pages ordered by id. "after" is the id of the last job on the
+            # previous page.
+            limit = self.get_query_argument('limit', None)
+            try:
+                limit = int(limit) if limit is not None else None
+                after = int(self.get_query_argument('after', 0))
+            except ValueError:
+                raise HTTPError(400, 'Both "limit" and "after" must be integers.')
+
+            job_types = self.registry.job_types
+
+            # Stream every job (after the cursor) as newline delimited JSON, or the first `limit`
+            if self.get_query_argument('format', None) == 'ndjson':
+                if limit is not None and limit <= 0:
+                    raise HTTPError(400, '"limit" must be at least 1.')
+                return await self.stream_jobs(user_id, after, limit, job_types)
+
+            if limit is None:
+                limit = self.default_page_size
+            if not 0 < limit <= self.max_page_size:
+                raise HTTPError(400, '"limit" must be between 1 and {}.'.format(self.max_page_size))
+
+            # Get a page of jobs for user, plus one to tell whether there is another page
+            jobs = await self.db.execute("SELECT * FROM job WHERE user_id = ? AND id > ? "
+                                         "ORDER BY id LIMIT ?;", user_id, after, limit + 1)
+            next_after = jobs[limit - 1][0] if len(jobs) > limit else None
             return self.write({
                 'id': 'success',
                 'description': 'List all jobs for the given user.',
                 'data': {
-                    'jobs': [
-                        {
-                            'name': j[2],
-                            'type': job_types[j[3]],
-                            'data': j[4],
-                            'schedule': j[5],
-                            'last_ran': j[7],
-                            'done': True if j[6] is 1 else False
-                        } for j in jobs
-                    ],
+                    'jobs': [self.job_to_dict(j, job_types) for j in jobs[:limit]],
+                    'next_after': next_after,
                 }
             })
 
@@ -52,25 +103,15 @@ class JobPageHandler(BasePageHandler):
                                 .format(job_name))
 
             job = job[0]
-            job_types = await self.db.execute("SELECT id, name FROM job_type;")
-            job_types = {k: v for k, v in job_types}
-            job_results = await self.db.execute("SELECT id, result, date_created FROM job_result "
-                                                "WHERE job_id = ? ORDER BY id DESC LIMIT 25",
-                                                job[0])
+            job_types = self.registry.job_types
+            job_results = await latest_results(self.db, job[0], 25)
 
             return self.write({
                 'id': 'success',
                 'description': 'Information for job "{}"'.format(job_name),
                 'data': {
-                    'job': {
-                        'name': job_name,
-                        'type': job_types[job[3]],
-                        'data': job[4],
-                        'schedule': job[5],
-                        'last_ran': job[7],
-                        'done': True if job[6] is 1 else False
-                    },
-                    'job_runs': [{'result': r[1], 'timestamp': utc_to_date(float(r[2])).isoformat()}
+                    'job': self.job_to_dict(job, job_types),
+                    'job_runs': [{'result': r[0], 'timestamp': utc_to_date(float(r[1])).isoformat()}
                                  for r in job_results]
                 }
             })
@@ -89,31 +130,129 @@ class JobPageHandler(BasePageHandler):
             raise HTTPError(400, 'Must include the following form data: "name", "type", "data", '
                                  '"schedule"')
 
+        # Check the schedule string is valid before the job is stored
+        try:
+            schedule = compile_schedule(job_schedule)
+        except ParseError as e:
+            raise HTTPError(400, 'Invalid schedule "{}". {}'.format(job_schedule, str(e).strip()))
+
+        # Check the job type exists and the data fits its schema
+        job_type_obj = self.registry.by_name.get(job_type)
+        if job_type_obj is None:
+            raise HTTPError(400, 'Job type "{}" does not exist.'.format(job_type))
+        try:
+            self.registry.validate(job_type_obj, job_data)
+        except JobDataError as e:
+            raise HTTPError(400, str(e))
+
         # Create a job from the post data
-        job_type_id = await self.db.execute("SELECT * FROM job_type WHERE name = ?", job_type)
-        if job_type_id:
-            job_type_id = job_type_id[0][0]
-            time_now = now().timestamp()
-            await self.db.execute('INSERT INTO job (id, user_id, name, type_id, data, schedule, '
-                                  'date_created, date_updated) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?);',
-                                  user_id, job_name, job_type_id, job_data, job_schedule,
-                                  time_now, time_now)
-            job = await self.db.execute('SELECT * FROM job WHERE user_id = ? AND name = ?',
-                                        user_id, job_name)
-            job = job[0]
-            job_obj = Job(*job)
-            await self.scheduler.work_queue.put(job_obj)
-            return self.write({
-                'id': 'success',
-                'description': 'Successfully created {0} job: "{1}"'.format(job_type, job_name),
-                'data': {
-                    'name': job_name,
-                    'type': job_type,
-                    'data': job_data,
-                    'schedule': job_schedule,
-                    'date_created': time_now,
-                    'date_updated': time_now,
-                }
-            })
+        time_now = now(as_utc=True)
+        await self.db.execute('INSERT INTO job (id, user_id, name, type_id, data, schedule, '
+                              'date_created, date_updated, next_run_at) '
+                              'VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?);',
+                              user_id, job_name, job_type_obj.id, job_data, job_schedule,
+                              time_now, time_now, schedule.next_after(time_now))
+        job = await self.db.execute('SELECT * FROM job WHERE user_id = ? AND name = ?',
+                                    user_id, job_name)
+        job = job[0]
+        job_obj = Job(*job)
+        await self.scheduler.submit(job_obj)
+        return self.write({
+            'id': 'success',
+            'description': 'Successfully created {0} job: "{1}"'.format(job_type, job_name),
+            'data': {
+                'name': job_name,
+                'type': job_type,
+                'data': job_data,
+                'schedule': job_schedule,
+                'date_created': time_now,
+                'date_updated': time_now,
+            }
+        })
+
+    async def get_job_row(self, user_id, job_name):
+        """The user's job with the given name, or a 404."""
+        if job_name is None:
+            raise HTTPError(400, 'Must include the name of the job.')
+        job = await self.db.execute("SELECT * FROM job WHERE user_id = ? AND name = ?",
+                                    user_id, job_name)
+        if len(job) == 0:
+            raise HTTPError(404, 'Job "{}" does not exist for the current user.'.format(job_name))
+        return job[0]
+
+    async def put(self):
+        # Check for auth token
+        auth_token = self.request.headers.get('X-Auth-Token', None)
+        user_id = await self.application.validate_auth_token(auth_token)
+
+        # Anything not supplied is left as it is
+        job_name = self.get_argument('name', None)
+        job = await self.get_job_row(user_id, job_name)
+        job_types = self.registry.job_types
+        job_type = self.get_argument('type', job_types[job[3]].name)
+        job_data = self.get_argument('data', job[4])
+        job_schedule = self.get_argument('schedule', job[5])
+        paused = self.get_argument('paused', None)
+        if paused is None:
+            paused = bool(job[13])
+        elif paused.lower() in ('true', '1', 'false', '0'):
+            paused = paused.lower() in ('true', '1')
         else:
+            raise HTTPError(400, '"paused" must be true or false.')
+
+        # Check the changes the same way as a new job
+        try:
+            schedule = compile_schedule(job_schedule)
+        except ParseError as e:
+            raise HTTPError(400, 'Invalid schedule "{}". {}'.format(job_schedule, str(e).strip()))
+        job_type_obj = self.registry.by_name.get(job_type)
+        if job_type_obj is None:
             raise HTTPError(400, 'Job type "{}" does not exist.'.format(job_type))
+        try:
+            self.registry.validate(job_type_obj, job_data)
+        except JobDataError as e:
+            raise HTTPError(400, str(e))
+
+        # Store the changes, then swap the scheduled job for the new version (or cancel it when it
+        # is paused)
+        time_now = now(as_utc=True)
+        last_ran = float(job[7] if job[7] is not None else job[8])
+        await self.db.execute('UPDATE job SET type_id = ?, data = ?, schedule = ?, paused = ?, '
+                              'date_updated = ?, next_run_at = ? WHERE id = ?;',
+                              job_type_obj.id, job_data, job_schedule, int(paused), time_now,
+                              schedule.next_after(last_ran), job[0])
+        job = await self.get_job_row(user_id, job_name)
+        job_obj = Job(*job)
+        if job_obj.paused:
+            await self.scheduler.cancel(job_obj.id)
+        else:
+            await self.scheduler.submit(job_obj)
+        return self.write({
+            'id': 'success',
+            'description': 'Successfully updated job: "{}"'.format(job_name),
+            'data': dict(self.job_to_dict(job, job_types), date_updated=time_now),
+        })
+
+    async def delete(self):
+        # Check for auth token
+        auth_token = self.request.headers.get('X-Auth-Token', None)
+        user_id = await self.application.validate_auth_token(auth_token)
+
+        job_name = self.get_argument('name', None)
+        job = await self.get_job_row(user_id, job_name)
+
+        # Remove the job with its results in one transaction, then stop scheduling it. The bodies
+        # of the results are collected by the retention task.
+        def delete_job(connection, job_id):
+            connection.execute('DELETE FROM job_result WHERE job_id = ?;', (job_id,))
+            connection.execute('DELETE FROM job_result_rollup WHERE job_id = ?;', (job_id,))
+            connection.execute('DELETE FROM job_stats WHERE job_id = ?;', (job_id,))
+            connection.execute('DELETE FROM job WHERE id = ?;', (job_id,))
+            connection.commit()
+
+        await self.db.run_in_writer(delete_job, job[0])
+        await self.scheduler.cancel(job[0])
+        return self.write({
+            'id': 'success',
+            'description': 'Successfully deleted job: "{}"'.format(job_name),
+        })
@@ -0,0 +1,149 @@
+"""
+src/routes/job_bulk.py
+
+Bulk job "/job/bulk" route, for creating thousands of jobs in one request.
+"""
+
+import json
+
+from tornado.web import HTTPError
+
+from ._base import BasePageHandler
+from ..scheduler import Job, compile_schedule, ParseError, JobDataError
+from ..utils.dates import now
+
+
+class JobBulkPageHandler(BasePageHandler):
+
+    # Most jobs accepted in one request
+    max_jobs = 50000
+
+    # Most names looked up by a single "IN (...)" query, well under SQLite's limit on parameters
+    lookup_chunk_size = 500
+
+    def parse_body(self):
+        """The jobs in the request body: a JSON array of objects, or one JSON object per line."""
+        body = self.request.body.decode('utf8').strip()
+        try:
+            if body.startswith('['):
+                items = json.loads(body)
+            else:
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        except ValueError:
+            raise HTTPError(400, 'Body must be a JSON array of jobs, or one JSON job per line.')
+        if not items:
+            raise HTTPError(400, 'No jobs were given.')
+        if len(items) > self.max_jobs:
+            raise HTTPError(400, 'At most {} jobs can be created at once.'.format(self.max_jobs))
+        return items
+
+    def check_item(self, item, time_now: float):
+        """Validate one job of the batch. Returns its job table values, or raises ValueError."""
+        if not isinstance(item, dict):
+            raise ValueError('Job must be a JSON object.')
+        if any(item.get(key) is None for key in ('name', 'type', 'data', 'schedule')):
+            raise ValueError('Must include "name", "type", "data" and "schedule".')
+
+        for key in ('type', 'schedule'):
+            if not isinstance(item[key], str):
+                raise ValueError('"{}" must be a string.'.format(key))
+
+        # "data" may be given as an object, or (like the form field) as a JSON string
+        job_data = item['data']
+        if not isinstance(job_data, (dict, str)):
+            raise ValueError('"data" must be an object, or a JSON string.')
+        if not isinstance(job_data, str):
+            job_data = json.dumps(job_data)
+
+        try:
+            schedule = compile_schedule(item['schedule'])
+        except ParseError as e:
+            raise ValueError('Invalid schedule "{}". {}'.format(item['schedule'], str(e).strip()))
+
+        job_type = self.registry.by_name.get(item['type'])
+        if job_type is None:
+            raise ValueError('Job type "{}" does not exist.'.format(item['type']))
+        try:
+            self.registry.validate(job_type, job_data)
+        except JobDataError as e:
+            raise ValueError(str(e))
+
+        return (str(item['name']), job_type.id, job_data, item['schedule'], time_now, time_now,
+                schedule.next_after(time_now))
+
+    def insert_jobs(self, connection, user_id: int, values: list):
+        """Insert the jobs in one transaction on the writer thread, skipping names the user already
+        has. Returns the names skipped and the rows inserted."""
+        names = [row[0] for row in values]
+
+        def select_names(columns):
+            found = []
+            for start in range(0, len(names), self.lookup_chunk_size):
+                chunk = names[start:start + self.lookup_chunk_size]
+                found.extend(connection.execute(
+                    'SELECT {} FROM job WHERE user_id = ? AND name IN ({});'.format(
+                        columns, ', '.join('?' * len(chunk))), [user_id] + chunk))
+            return found
+
+        connection.execute('BEGIN IMMEDIATE;')
+        existing = {row[0] for row in select_names('name')}
+        connection.executemany(
+            'INSERT INTO job (id, user_id, name, type_id, data, schedule, date_created, '
+            'date_updated, next_run_at) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?);',
+            [(user_id,) + row for row in values if row[0] not in existing])
+        rows = [row for row in select_names('*') if row[2] not in existing]
+        connection.commit()
+        return existing, rows
+
+    async def post(self):
+        # Check for auth token
+        auth_token = self.request.headers.get('X-Auth-Token', None)
+        user_id = await self.application.validate_auth_token(auth_token)
+
+        # Check every job up front, so only valid jobs reach the database
+        items = self.parse_body()
+        time_now = now(as_utc=True)
+        statuses = []
+        values = {}
+        for index, item in enumerate(items):
+            status = {'index': index, 'name': item.get('name') if isinstance(item, dict) else None}
+            try:
+                row = self.check_item(item, time_now)
+                status['name'] = row[0]
+                if row[0] in values:
+                    raise ValueError('Job "{}" appears more than once.'.format(row[0]))
+                values[row[0]] = row
+            except ValueError as e:
+                status['status'] = 'error'
+                status['error'] = str(e)
+            statuses.append(status)
+
+        # Insert every valid job in a single transaction
+        existing, rows = set(), []
+        if values:
+            existing, rows = await self.db.run_in_writer(self.insert_jobs, user_id,
+                                                         list(values.values()))
+
+        # Hand the new jobs to the scheduler in one batch
+        jobs = [Job(*row) for row in rows]
+        await self.scheduler.submit_many(jobs)
+
+        created = {job.name for job in jobs}
+        for status in statuses:
+            if 'status' in status:
+                continue
+            if status['name'] in existing:
+                status['status'] = 'error'
+                status['error'] = 'Job "{}" already exists.'.format(status['name'])
+            elif status['name'] in created:
+                status['status'] = 'created'
+
+        return self.write({
+            'id': 'success',
+            'description': 'Created {} of {} jobs.'.format(len(jobs), len(items)),
+            'data': {
+                'created': len(jobs),
+                'failed': len(items) - len(jobs),
+                'jobs': statuses,
+            }
+        })
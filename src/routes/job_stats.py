@@ -0,0 +1,66 @@
+"""
+src/routes/job_stats.py
+
+Job stats "/job/stats" route: how each of the user's jobs has been doing, read from the running
+stats the runners keep rather than from the job's results.
+"""
+
+from tornado.web import HTTPError
+
+from ._base import BasePageHandler
+from ..database import JobSummary
+
+
+class JobStatsPageHandler(BasePageHandler):
+
+    # Number of jobs listed per page, unless "limit" says otherwise
+    default_page_size = 100
+    max_page_size = 1000
+
+    @staticmethod
+    def stats_to_dict(row):
+        """Public representation of a job's name followed by its job_stats row (which is all None
+        if the job hasn't run yet)."""
+        summary = JobSummary.from_row(row[1:]) if row[1] is not None else JobSummary()
+        return dict(summary.to_dict(), name=row[0])
+
+    async def get(self):
+        # Check for auth token
+        auth_token = self.request.headers.get('X-Auth-Token', None)
+        user_id = await self.application.validate_auth_token(auth_token)
+
+        job_name = self.get_query_argument('name', None)
+        if job_name is not None:
+            rows = await self.db.execute('SELECT j.name, s.* FROM job j LEFT JOIN job_stats s '
+                                         'ON s.job_id = j.id WHERE j.user_id = ? AND j.name = ?;',
+                                         user_id, job_name)
+            if not rows:
+                raise HTTPError(404, 'Job "{}" does not exist for the current user.'
+                                .format(job_name))
+            return self.write({
+                'id': 'success',
+                'description': 'Stats for job "{}"'.format(job_name),
+                'data': self.stats_to_dict(rows[0]),
+            })
+
+        # Jobs are listed in pages ordered by id, like "/job"
+        try:
+            limit = int(self.get_query_argument('limit', self.default_page_size))
+            after = int(self.get_query_argument('after', 0))
+        except ValueError:
+            raise HTTPError(400, 'Both "limit" and "after" must be integers.')
+        if not 0 < limit <= self.max_page_size:
+            raise HTTPError(400, '"limit" must be between 1 and {}.'.format(self.max_page_size))
+
+        rows = await self.db.execute('SELECT j.id, j.name, s.* FROM job j LEFT JOIN job_stats s '
+                                     'ON s.job_id = j.id WHERE j.user_id = ? AND j.id > ? '
+                                     'ORDER BY j.id LIMIT ?;', user_id, after, limit + 1)
+        next_after = rows[limit - 1][0] if len(rows) > limit else None
+        return self.write({
+            'id': 'success',
+            'description': 'Stats for all jobs of the given user.',
+            'data': {
+                'jobs': [self.stats_to_dict(row[1:]) for row in rows[:limit]],
+                'next_after': next_after,
+            }
+        })
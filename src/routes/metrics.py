@@ -0,0 +1,17 @@
+"""
+src/routes/metrics.py
+
+Metrics "/metrics" route, in the Prometheus text format. With scheduler workers, their metrics are
+added to the API process' own.
+"""
+
+from ._base import BasePageHandler
+from ..utils.metrics import metrics
+
+
+class MetricsPageHandler(BasePageHandler):
+    """Page handler for metrics ('/metrics') route."""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render(self.scheduler.worker_metrics()))
@@ -41,7 +41,7 @@ class RegisterPageHandler(BasePageHandler):
 
         # Register the user
         password = hashlib.sha256(bytes(password, encoding='utf8')).hexdigest()
-        time_now = now().timestamp()
+        time_now = now(as_utc=True)
         await self.db.execute("INSERT INTO user (id, username, password, date_created, "
                               "date_updated) VALUES (NULL, ?, ?, ?, ?);", username, password,
                               time_now, time_now)
@@ -1,3 +1,5 @@
 from .job_scheduler import JobScheduler
+from .shards import ShardSupervisor
 from .job import Job
-from .parser import parse
+from .parser import parse, compile_schedule, ParseError
+from .job_runners import JobRunnerRegistry, JobType, JobDataError
@@ -0,0 +1,106 @@
+"""
+src/scheduler/dispatcher.py
+
+A bucketed timer (a single-level timing wheel with a heap of occupied slots) which holds every
+scheduled job until it is due. The scheduler wakes once per tick and pops all of the due jobs in one
+batch, instead of parking one sleeping coroutine per job on the event loop.
+"""
+
+import heapq
+import math
+
+
+class Dispatcher(object):
+    """Holds scheduled jobs in time slots of `tick` seconds, keyed by their next fire time. Times
+    may be on any clock, as long as every call uses the same one.
+
+    Each job is stored under a key (its id), so pushing the same key again moves the job rather than
+    scheduling it twice.
+    """
+
+    def __init__(self, tick: float = 0.1):
+        """Constructor."""
+        self.tick = tick
+
+        # Mapping of slot number -> list of (fire_time, key, job) entries in that slot
+        self._slots = {}
+
+        # Min-heap of slot numbers, so the earliest slot is always at index 0. Slots emptied by
+        # discard() are left in the heap and skipped when they reach the top.
+        self._slot_heap = []
+
+        # Mapping of key -> (slot number, entry) for every scheduled job
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        """Keys of every scheduled job."""
+        return list(self._index)
+
+    def _slot_for(self, fire_time: float):
+        """Slot number for a fire time. Rounded up so a job never fires before its time."""
+        return math.ceil(fire_time / self.tick)
+
+    def push(self, fire_time: float, job, key=None):
+        """Schedule a job to fire at the given time, replacing any job with the same key."""
+        key = id(job) if key is None else key
+        self.discard(key)
+
+        slot = self._slot_for(fire_time)
+        entries = self._slots.get(slot)
+        if entries is None:
+            entries = self._slots[slot] = []
+            heapq.heappush(self._slot_heap, slot)
+        entry = (fire_time, key, job)
+        entries.append(entry)
+        self._index[key] = (slot, entry)
+
+    def discard(self, key):
+        """Remove the job with the given key, if it is scheduled. Returns the job or None."""
+        found = self._index.pop(key, None)
+        if found is None:
+            return None
+        slot, entry = found
+        entries = self._slots[slot]
+        entries.remove(entry)
+        if not entries:
+            del self._slots[slot]
+        return entry[2]
+
+    def pop_due(self, time_now: float):
+        """Remove and return every job which is due at (or before) the given time."""
+        due = []
+        last_slot = math.floor(time_now / self.tick)
+        while self._slot_heap and self._slot_heap[0] <= last_slot:
+            slot = heapq.heappop(self._slot_heap)
+            for _, key, job in self._slots.pop(slot, ()):
+                del self._index[key]
+                due.append(job)
+        return due
+
+    def next_fire_time(self):
+        """Time of the earliest occupied slot, or None if nothing is scheduled."""
+        while self._slot_heap and self._slot_heap[0] not in self._slots:
+            heapq.heappop(self._slot_heap)
+        if not self._slot_heap:
+            return None
+        return self._slot_heap[0] * self.tick
+
+    def due_within(self, seconds: float, time_now: float):
+        """Count the jobs due in the next `seconds` seconds (overdue jobs included).
+
+        Cost is bounded by whichever is smaller: the number of slots in the window or the number of
+        occupied slots, never by the number of scheduled jobs.
+        """
+        if self.next_fire_time() is None:
+            return 0
+        first_slot = self._slot_heap[0]
+        last_slot = math.floor((time_now + seconds) / self.tick)
+        if last_slot - first_slot < len(self._slots):
+            return sum(len(self._slots.get(slot, ())) for slot in range(first_slot, last_slot + 1))
+        return sum(len(entries) for slot, entries in self._slots.items() if slot <= last_slot)
@@ -11,7 +11,8 @@ class Job(object):
     """Wrapper around a job, providing convenience functions and typing."""
 
     def __init__(self, id_=None, user_id=None, name=None, type_id=None, data=None, schedule=None,
-                 done=None, last_ran=None, date_created=None, date_updated=None):
+                 done=None, last_ran=None, date_created=None, date_updated=None, next_run_at=None,
+                 lease_owner=None, lease_expires=None, paused=0):
         """Constructor."""
         self.id = id_
         self.user_id = user_id
@@ -23,6 +24,17 @@ class Job(object):
         self.last_ran = float(last_ran) if last_ran is not None else None
         self.date_created = date_created
         self.date_updated = date_updated
+        self.next_run_at = float(next_run_at) if next_run_at is not None else None
+
+        # The scheduler currently running the job, and until when
+        self.lease_owner = lease_owner
+        self.lease_expires = float(lease_expires) if lease_expires is not None else None
+
+        # Paused jobs are not scheduled until they are resumed
+        self.paused = bool(paused)
+
+        # Number of missed runs still to fire under the "fire_all" misfire policy
+        self.catchup_remaining = 0
 
         if isinstance(self.schedule, str) and self.schedule.startswith('once'):
             self.run_once = True
@@ -1,2 +1,3 @@
 from ._base import AbstractJobRunner
 from .http import HTTPJobRunner
+from .registry import JobRunnerRegistry, JobType, JobDataError
@@ -13,6 +13,10 @@ from ..job import Job
 class AbstractJobRunner(ABC):
     """Abstract class for all other job runners in implement. For type hinting, yo."""
 
+    # Schema of the data taken by this runner's jobs, stored as the job type's "detail". Maps each
+    # field to {"type": "string"|"number"|"integer"|"boolean", "description": "..."}.
+    detail = {}
+
     @classmethod
     @abstractmethod
     def load_class(cls, *args, **kwargs):
@@ -25,6 +29,10 @@ class AbstractJobRunner(ABC):
         pass
 
     @abstractmethod
-    def run(self, job: Job, delay: float):
-        """Run a given job."""
+    def run(self, job: Job):
+        """Run a given job. Called by the scheduler once the job is due, so it must not block.
+
+        The scheduler holds the job's lease while it runs. Recording the run must also give the
+        lease back, by setting the job's "lease_owner" and "lease_expires" to NULL.
+        """
         pass
@@ -0,0 +1,76 @@
+"""
+src/scheduler/job_runners/breaker.py
+
+Per host circuit breakers. After enough failures in a row a host's circuit opens and requests to it
+fail fast, without taking a connection, until a single probe request (half open) shows the host is
+healthy again.
+"""
+
+import time
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for one host."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """Constructor."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        """May a request be made to the host right now?"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+
+        # Half open: let one probe request through at a time
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class CircuitBreakers(object):
+    """A circuit breaker for every host, created as they are first needed."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """Constructor."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+
+    def __getitem__(self, host: str) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(self.failure_threshold,
+                                                            self.reset_timeout)
+        return breaker
+
+    def open_hosts(self):
+        """Hosts whose circuit is not closed."""
+        return [host for host, breaker in self._breakers.items()
+                if breaker.state != CircuitBreaker.CLOSED]
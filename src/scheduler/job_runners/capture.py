@@ -0,0 +1,50 @@
+"""
+src/scheduler/job_runners/capture.py
+
+Capture an HTTP response body as it streams in, keeping only what the job asks for, so a large
+response is never held in memory (or stored) in full.
+"""
+
+import hashlib
+
+
+class ResponseCapture(object):
+    """Streaming callback which records the size of a response body and, depending on the policy,
+    its first few bytes or its hash.
+
+    Policies:
+      * "none": only the size is recorded
+      * "head": the first `max_bytes` bytes are kept
+      * "hash": the SHA-256 of the body is recorded, plus its size
+    """
+
+    policies = ('none', 'head', 'hash')
+
+    def __init__(self, policy: str = 'head', max_bytes: int = 65536):
+        """Constructor."""
+        self.policy = policy if policy in self.policies else 'head'
+        self.max_bytes = max(0, int(max_bytes))
+        self.size = 0
+        self._head = []
+        self._head_size = 0
+        self._hash = hashlib.sha256() if self.policy == 'hash' else None
+
+    def __call__(self, chunk: bytes):
+        """Receive the next chunk of the response body."""
+        self.size += len(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        elif self.policy == 'head' and self._head_size < self.max_bytes:
+            chunk = chunk[:self.max_bytes - self._head_size]
+            self._head.append(chunk)
+            self._head_size += len(chunk)
+
+    def result(self):
+        """What was captured, ready to be stored with the job result."""
+        result = {'size': self.size}
+        if self.policy == 'head':
+            result['body'] = b''.join(self._head).decode('utf8', errors='replace')
+            result['truncated'] = self.size > self._head_size
+        elif self.policy == 'hash':
+            result['sha256'] = self._hash.hexdigest()
+        return result
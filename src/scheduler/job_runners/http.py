@@ -5,21 +5,113 @@ Job runner for handling all jobs with the "http" type.
 """
 
 import asyncio
-import json
+import random
+import time
 
-from tornado.httpclient import AsyncHTTPClient
+from urllib.parse import urlsplit
+from tornado.httpclient import AsyncHTTPClient, HTTPError
 from tornado.platform.asyncio import to_asyncio_future
 
 from ._base import AbstractJobRunner, Job
-from ...database import DB
+from .breaker import CircuitBreakers
+from .capture import ResponseCapture
+from .limits import RequestLimiter
+from .registry import JobDataError, check_data
+from ..parser import compile_schedule
+from ...database import DB, JobStats, ResultBlobs
 from ...utils.dates import now
+from ...utils.metrics import metrics
+
+
+requests_in_flight = metrics.gauge('veggiecron_http_requests_in_flight',
+                                   'Requests being made by the HTTP job runner.')
+request_seconds = metrics.histogram('veggiecron_http_request_seconds',
+                                    'Seconds taken by HTTP job requests, from sending to the last '
+                                    'byte.')
+request_queued_seconds = metrics.histogram('veggiecron_http_request_queued_seconds',
+                                           'Seconds HTTP job requests waited on their host and job '
+                                           'limits.')
+requests_made = metrics.counter('veggiecron_http_requests', 'HTTP job requests, by outcome.',
+                                ('outcome',))
 
 
 class HTTPJobRunner(AbstractJobRunner):
     """Responsible for running HTTP jobs."""
 
+    # Schema of an HTTP job's data
+    detail = {
+        'url': {
+            'type': 'string',
+            'description': "URL prepended with 'http://'.",
+        },
+        'number_of_clones': {
+            'type': 'integer',
+            'description': "Don't just make the request one time on every interval. Do it X number "
+                           "of times.",
+        },
+        'verb': {
+            'type': 'string',
+            'description': 'HTTP verbs: [GET, POST, PUT, DELETE]',
+        },
+        'enable_shadows': {
+            'type': 'boolean',
+            'description': 'Turn on shadows if you want this job to run again even if the last run '
+                           'is still active. (For long running requests.)',
+        },
+        'capture': {
+            'type': 'string',
+            'required': False,
+            'description': 'What to keep of the response body: "none" (size only), "head" (the '
+                           'first capture_bytes bytes) or "hash" (SHA-256 and size).',
+        },
+        'capture_bytes': {
+            'type': 'integer',
+            'required': False,
+            'description': 'Number of bytes kept with the "head" capture policy.',
+        },
+        'connect_timeout': {
+            'type': 'number',
+            'required': False,
+            'description': 'Seconds to wait for a connection to the host.',
+        },
+        'request_timeout': {
+            'type': 'number',
+            'required': False,
+            'description': 'Seconds to wait for the whole request.',
+        },
+        'retries': {
+            'type': 'integer',
+            'required': False,
+            'description': 'Number of times a failed request (no response or a 5xx) is retried.',
+        },
+        'retry_backoff': {
+            'type': 'number',
+            'required': False,
+            'description': 'Longest wait in seconds before the first retry, doubled for each '
+                           'retry.',
+        },
+        'max_concurrency': {
+            'type': 'integer',
+            'required': False,
+            'description': 'Most requests this job may have in flight at once.',
+        },
+        'rate_limit': {
+            'type': 'number',
+            'required': False,
+            'description': 'Most requests this job may start per second.',
+        },
+    }
+
+    # How much of each response body is kept, unless the job's data says otherwise
+    default_capture = 'head'
+    default_capture_bytes = 65536
+
     # Will be overwritten in load_class class method.
     http_client = None
+    limiter = None
+    breakers = None
+    results = None
+    stats = None
     scheduler_queue = None
 
     # Maximum number of open requests at any given time
@@ -27,52 +119,120 @@ class HTTPJobRunner(AbstractJobRunner):
     max_open_requests = 200
 
     @classmethod
-    def load_class(cls, db: DB, scheduler_queue: asyncio.Queue):
-        """Prepare any resources to be shared among all instances of this job runner."""
+    def load_class(cls, db: DB, scheduler_queue: asyncio.Queue, backend: str = 'simple',
+                   max_clients: int = None, max_connections: int = None,
+                   dns_cache_seconds: int = 300, host_concurrency: int = None,
+                   host_rate: float = None, host_burst: float = None, job_concurrency: int = None,
+                   job_rate: float = None, connect_timeout: float = 5, request_timeout: float = 20,
+                   retries: int = 0, retry_backoff: float = 0.5, retry_backoff_max: float = 30,
+                   breaker_failures: int = 5, breaker_reset_seconds: float = 30,
+                   result_codec: str = 'zlib', result_level: int = None,
+                   stats_flush_seconds: float = 10):
+        """Prepare any resources to be shared among all instances of this job runner.
+
+        The "curl" backend keeps connections to each target host alive between runs (up to
+        `max_connections` cached connections) and caches DNS lookups for `dns_cache_seconds`. The
+        "simple" backend opens a new connection for every request.
+
+        Requests to one host are capped at `host_concurrency` at once and `host_rate` per second,
+        and requests from one job at `job_concurrency` and `job_rate` (which the job's data can
+        override). Unset limits are not enforced.
+
+        Timeouts and retries are defaults for jobs which don't set their own. A failed request is
+        retried up to `retries` times, waiting a random time of up to `retry_backoff` seconds,
+        doubled on each attempt (at most `retry_backoff_max`). After `breaker_failures` failures in
+        a row, requests to a host fail fast for `breaker_reset_seconds` before it is probed again.
+
+        Response bodies are stored compressed with `result_codec` ("zlib", "lzma" or "none") at
+        `result_level` (the codec's default if unset), once per distinct body. Every request is
+        also added to its job's stats, which are saved every `stats_flush_seconds`.
+        """
+        cls.limiter = RequestLimiter(host_concurrency, host_rate, host_burst, job_concurrency,
+                                     job_rate)
+        cls.breakers = CircuitBreakers(breaker_failures, breaker_reset_seconds)
+        cls.default_connect_timeout = connect_timeout
+        cls.default_request_timeout = request_timeout
+        cls.default_retries = retries
+        cls.default_retry_backoff = retry_backoff
+        cls.retry_backoff_max = retry_backoff_max
+
+        if max_clients is not None:
+            cls.max_open_requests = max_clients
+
         # Create a tornado async HTTP client for making requests
-        cls.http_client = AsyncHTTPClient(max_clients=cls.max_open_requests)
+        cls.http_client = None
+        if backend == 'curl':
+            cls.http_client = cls.create_curl_client(max_connections, dns_cache_seconds)
+        elif backend != 'simple':
+            print('[HTTPJobRunner] Unknown HTTP backend "{}", using "simple".'.format(backend))
+        if cls.http_client is None:
+            cls.http_client = AsyncHTTPClient(max_clients=cls.max_open_requests)
 
         # Bind the database connection to the class
         cls.db = db
+        cls.results = ResultBlobs(db, result_codec, result_level)
+        cls.stats = JobStats(db, stats_flush_seconds)
+        cls.stats.start()
 
         # Bind the scheduler queue to the class
         cls.scheduler_queue = scheduler_queue
 
+    @classmethod
+    def create_curl_client(cls, max_connections: int, dns_cache_seconds: int):
+        """Create a pycurl based HTTP client, or return None if pycurl is not installed."""
+        try:
+            import pycurl
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+        except ImportError:
+            print('[HTTPJobRunner] pycurl is not installed, using the "simple" HTTP backend.')
+            return None
+
+        def prepare_curl(curl):
+            curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_cache_seconds)
+
+        client = CurlAsyncHTTPClient(max_clients=cls.max_open_requests,
+                                     defaults={'prepare_curl_callback': prepare_curl})
+
+        # Size of the cache of open connections shared by every request, which is what lets the
+        # requests to a host reuse its connections. Tornado doesn't expose its curl multi handle.
+        if max_connections:
+            multi = getattr(client, '_multi', None)
+            if multi is not None:
+                multi.setopt(pycurl.M_MAXCONNECTS, max_connections)
+            else:
+                print('[HTTPJobRunner] Could not set max_connections, the curl client has no multi '
+                      'handle. Using the default connection cache size.')
+        return client
+
     def load(self):
         """Prepare any resources for this instance of the job runner."""
         pass
 
-    async def run(self, job: Job, delay: float):
+    def run(self, job: Job):
         """Run an HTTP job."""
-        # Delay the job execution until the scheduled time
-        if delay > 0:
-            await asyncio.sleep(delay)
+        # Check the job's options once, up front. Jobs created before a field was checked (or
+        # changed in the database) may hold anything, and a bad value mustn't stop the job.
+        try:
+            check_data(self.detail, job.data)
+        except JobDataError as e:
+            asyncio.ensure_future(self.fail_run(job, str(e)))
+            return
 
         # "Queue up" x HTTP requests, where x is the job's "number_of_clones"
         job_future = asyncio.gather(*[self.handle_request(job)
                                       for _ in range(job.data['number_of_clones'])])
 
-        # Create an async function for running the job with shadows disabled
+        # Create an async function for running the job with shadows enabled
         async def run_with_shadows():
-            asyncio.ensure_future(job_future)
-            job.last_ran = now(as_utc=True)
-            await self.db.execute('UPDATE job SET last_ran = ? WHERE id = ?', job.last_ran, job.id)
-            if job.run_once is False:
-                await self.scheduler_queue.put(job)
-            else:
-                asyncio.ensure_future(self.db.execute('UPDATE job SET done = 1 WHERE id = ?',
-                                                      job.id))
+            job_future.add_done_callback(lambda future: self.log_failure(job, future))
+            await self.finish_run(job)
 
-        # Create an async function for running the job with shadows enabled
+        # Create an async function for running the job with shadows disabled. The run is always
+        # recorded and the job handed back, even if its requests failed unexpectedly.
         async def run_without_shadows():
-            await job_future
-            job.last_ran = now(as_utc=True)
-            await self.db.execute('UPDATE job SET last_ran = ? WHERE id = ?', job.last_ran, job.id)
-            if job.run_once is False:
-                await self.scheduler_queue.put(job)
-            else:
-                asyncio.ensure_future(self.db.execute('UPDATE job SET done = 1 WHERE id = ?',
-                                                      job.id))
+            await asyncio.wait([job_future])
+            self.log_failure(job, job_future)
+            await self.finish_run(job)
 
         # Run the job and depending on the "enable_shadows" option either queue the job right away
         # or after the job finishes running
@@ -81,18 +241,129 @@ class HTTPJobRunner(AbstractJobRunner):
         else:
             asyncio.ensure_future(run_without_shadows())
 
+    async def fail_run(self, job: Job, message: str):
+        """Record a run which couldn't be made (such as one with invalid job data) as a failed
+        request, then finish the run so the job is scheduled again."""
+        print('[HTTPJobRunner] Job "{}" not run: {}'.format(job.name, message))
+        result = {'code': 0, 'error': 'invalid_job', 'size': 0, 'elapsed': 0, 'queued': 0,
+                  'attempts': 0, 'body': message}
+        self.stats.record(job.id, result)
+        await self.persist_job_run(job, result)
+        await self.finish_run(job)
+
+    @staticmethod
+    def log_failure(job: Job, future):
+        """Log the error of a run whose requests failed unexpectedly."""
+        if not future.cancelled() and future.exception() is not None:
+            print('[HTTPJobRunner] Run of job "{}" failed: {!r}'.format(job.name,
+                                                                        future.exception()))
+
+    async def finish_run(self, job: Job):
+        """Record the run and store the job's next run time, giving back the job's lease, then hand
+        it back to the scheduler.
+
+        The next run time (and "done") are only stored if the job wasn't changed since this run
+        started, as they follow the schedule this version of the job had.
+        """
+        job.last_ran = now(as_utc=True)
+        if job.run_once is False:
+            job.next_run_at = compile_schedule(job.schedule).next_after(job.last_ran)
+            await self.db.execute('UPDATE job SET last_ran = ?, next_run_at = CASE WHEN '
+                                  'date_updated = ? THEN ? ELSE next_run_at END, '
+                                  'lease_owner = NULL, lease_expires = NULL WHERE id = ?',
+                                  job.last_ran, job.date_updated, job.next_run_at, job.id)
+            await self.scheduler_queue.put(job)
+        else:
+            job.next_run_at = None
+            await self.db.execute('UPDATE job SET last_ran = ?, next_run_at = CASE WHEN '
+                                  'date_updated = ? THEN NULL ELSE next_run_at END, '
+                                  'done = CASE WHEN date_updated = ? THEN 1 ELSE done END, '
+                                  'lease_owner = NULL, lease_expires = NULL WHERE id = ?',
+                                  job.last_ran, job.date_updated, job.date_updated, job.id)
+
     async def handle_request(self, job):
+        """Make one request for the job, retrying failures with backoff, and store the result."""
+        host = urlsplit(job.data['url']).netloc
+        retries = int(job.data.get('retries', self.default_retries))
+        attempts = 0
+        while True:
+            result = await self.attempt_request(job, host)
+            attempts += 1
+
+            # Don't retry when the circuit is open, the point is to leave the host alone
+            if not self.is_failure(result) or attempts > retries or 'error' in result:
+                break
+            await asyncio.sleep(self.backoff(job, attempts))
+
+        result['attempts'] = attempts
+        self.stats.record(job.id, result)
+        asyncio.ensure_future(self.persist_job_run(job, result))
+
+    async def attempt_request(self, job, host: str):
+        """Make a single request for the job and return its result.
+
+        The response body is passed to a ResponseCapture as it arrives instead of being buffered,
+        and the result records the response size and how long the request took.
+        """
+        breaker = self.breakers[host]
+        if not breaker.allow():
+            requests_made.labels('circuit_open').inc()
+            return {'code': 0, 'error': 'circuit_open', 'size': 0, 'elapsed': 0, 'queued': 0,
+                    'body': 'Not requested, {} has been failing.'.format(host)}
+
+        capture = ResponseCapture(job.data.get('capture', self.default_capture),
+                                  job.data.get('capture_bytes', self.default_capture_bytes))
+
+        # Wait for the target host (and the job) to be under their limits
+        queued = time.monotonic()
+        held = await self.limiter.acquire(host, job)
+        started = time.monotonic()
+        requests_in_flight.inc()
         try:
-            response = await to_asyncio_future(self.http_client.fetch(job.data['url'],
-                                                                      method=job.data['verb']))
-            result = json.dumps({'code': response.code, 'body': response.body.decode('utf8')})
-            asyncio.ensure_future(self.persist_job_run(job, result))
+            response = await to_asyncio_future(
+                self.http_client.fetch(
+                    job.data['url'], method=job.data['verb'], streaming_callback=capture,
+                    connect_timeout=job.data.get('connect_timeout', self.default_connect_timeout),
+                    request_timeout=job.data.get('request_timeout', self.default_request_timeout)))
+            code = response.code
+            error = None
+        except HTTPError as e:
+            # Non-2xx responses still have a status code (599 means there was no response at all)
+            code = e.code if e.code != 599 else 0
+            error = str(e)
         except Exception as e:
-            asyncio.ensure_future(
-                self.persist_job_run(job, json.dumps({'code': 0, 'body': str(e)}))
-            )
+            code = 0
+            error = str(e)
+        finally:
+            requests_in_flight.dec()
+            self.limiter.release(held)
+
+        result = capture.result()
+        result['code'] = code
+        result['elapsed'] = round(time.monotonic() - started, 6)
+        result['queued'] = round(started - queued, 6)
+        request_seconds.observe(result['elapsed'])
+        request_queued_seconds.observe(result['queued'])
+        requests_made.labels('{}xx'.format(code // 100) if code else 'error').inc()
+        if error is not None and code == 0:
+            result['body'] = error
+
+        if self.is_failure(result):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return result
+
+    @staticmethod
+    def is_failure(result):
+        """Did the request fail in a way worth retrying? (No response, or a server error.)"""
+        return result['code'] == 0 or result['code'] >= 500
+
+    def backoff(self, job, attempt: int):
+        """Seconds to wait before the next attempt: exponential backoff with full jitter."""
+        base = job.data.get('retry_backoff', self.default_retry_backoff)
+        return random.uniform(0, min(self.retry_backoff_max, base * 2 ** (attempt - 1)))
 
-    async def persist_job_run(self, job, result):
+    async def persist_job_run(self, job, result: dict):
         """Persist the results of a job."""
-        return await self.db.execute('INSERT INTO job_result (job_id, result, date_created) '
-                                     'VALUES (?, ?, ?)', job.id, result, now(as_utc=True))
+        return await self.results.store(job.id, result, now(as_utc=True))
@@ -0,0 +1,167 @@
+"""
+src/scheduler/job_runners/limits.py
+
+Concurrency caps and token bucket rate limits for outgoing requests, per target host and per job.
+Requests over a limit wait their turn in line (first come, first served) before they take one of
+the HTTP client's slots, so one busy host or job can't monopolise the client.
+"""
+
+import asyncio
+import time
+
+from collections import deque
+
+
+class Limit(object):
+    """A first-come-first-served gate letting through at most `concurrency` requests at once and at
+    most `rate` requests per second (with bursts of up to `burst`). Either limit may be None."""
+
+    def __init__(self, concurrency: int = None, rate: float = None, burst: float = None):
+        """Constructor."""
+        self.concurrency = concurrency or None
+        self.rate = rate or None
+        self.burst = max(1.0, float(burst or rate or 1))
+        self.active = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._waiters = deque()
+        self._timer = None
+
+    def _refill(self):
+        """Add the tokens earned since the last refill."""
+        if self.rate is None:
+            return
+        time_now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (time_now - self._updated) * self.rate)
+        self._updated = time_now
+
+    def _try_acquire(self):
+        """Let one request through if both limits allow it."""
+        if self.concurrency is not None and self.active >= self.concurrency:
+            return False
+        if self.rate is not None:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        self.active += 1
+        return True
+
+    async def acquire(self):
+        """Wait for a turn."""
+        if not self._waiters and self._try_acquire():
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self._wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Hand the turn on if it had already been given to this request
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Give back a turn."""
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        """Let waiting requests through, in order, for as long as the limits allow."""
+        while self._waiters:
+            if self._waiters[0].done():
+                self._waiters.popleft()
+                continue
+            if not self._try_acquire():
+                break
+            self._waiters.popleft().set_result(None)
+
+        # Waiting on the rate limit rather than on a running request, so check back when the next
+        # token is due
+        if self._waiters and self._timer is None and self.rate is not None and self._tokens < 1:
+            delay = (1 - self._tokens) / self.rate
+            self._timer = asyncio.get_event_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake()
+
+    def idle(self):
+        """Is nothing using this limit, with its bucket full again?"""
+        if self.active or self._waiters:
+            return False
+        self._refill()
+        return self.rate is None or self._tokens >= self.burst
+
+
+class RequestLimiter(object):
+    """Limits for every target host, and for every job, created as they are first needed."""
+
+    # Idle limits are cleared out after this many acquires
+    sweep_every = 1000
+
+    def __init__(self, host_concurrency: int = None, host_rate: float = None,
+                 host_burst: float = None, job_concurrency: int = None, job_rate: float = None):
+        """Constructor."""
+        self.host_concurrency = host_concurrency
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.job_concurrency = job_concurrency
+        self.job_rate = job_rate
+        self._hosts = {}
+        self._jobs = {}
+        self._acquires = 0
+
+    def _limit_for_job(self, job):
+        """The job's own limit. The job's data ("max_concurrency", "rate_limit") overrides the
+        defaults."""
+        concurrency = job.data.get('max_concurrency', self.job_concurrency)
+        rate = job.data.get('rate_limit', self.job_rate)
+        if not concurrency and not rate:
+            return None
+        limit = self._jobs.get(job.id)
+        if limit is None or (limit.concurrency, limit.rate) != (concurrency or None, rate or None):
+            limit = self._jobs[job.id] = Limit(concurrency, rate)
+        return limit
+
+    def _limit_for_host(self, host: str):
+        """The limit shared by every request to the host."""
+        if not self.host_concurrency and not self.host_rate:
+            return None
+        limit = self._hosts.get(host)
+        if limit is None:
+            limit = self._hosts[host] = Limit(self.host_concurrency, self.host_rate,
+                                              self.host_burst)
+        return limit
+
+    async def acquire(self, host: str, job):
+        """Wait until a request from the job to the host is allowed. Returns the limits held, to be
+        passed to release()."""
+        self._acquires += 1
+        if self._acquires % self.sweep_every == 0:
+            self.sweep()
+
+        # Wait on the job first, so a request doesn't hold a host slot while its job is throttled
+        held = []
+        try:
+            for limit in (self._limit_for_job(job), self._limit_for_host(host)):
+                if limit is not None:
+                    await limit.acquire()
+                    held.append(limit)
+        except BaseException:
+            self.release(held)
+            raise
+        return held
+
+    @staticmethod
+    def release(held):
+        """Give back the limits returned by acquire()."""
+        for limit in held:
+            limit.release()
+
+    def sweep(self):
+        """Forget limits nobody is using."""
+        for limits in (self._hosts, self._jobs):
+            for key in [key for key, limit in limits.items() if limit.idle()]:
+                del limits[key]
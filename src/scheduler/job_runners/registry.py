@@ -0,0 +1,146 @@
+"""
+src/scheduler/job_runners/registry.py
+
+Registry of job runners. The job types are loaded from the database once at startup and shared by
+the routes and the scheduler, and each type is matched to a runner class listed in config.yaml, so a
+new job type only needs a runner class and a line of config.
+"""
+
+import importlib
+import json
+
+from collections import namedtuple
+
+from ._base import AbstractJobRunner
+from ...database import DB
+
+
+# A row of the job_type table, with its parsed "detail" schema and the runner for its jobs
+JobType = namedtuple('JobType', ('id', 'name', 'detail', 'runner'))
+
+# Python types accepted for each type named in a job type's "detail" schema
+schema_types = {
+    'string': (str,),
+    'number': (int, float),
+    'integer': (int,),
+    'boolean': (bool,),
+}
+
+
+class JobDataError(ValueError):
+    """Job data does not match the job type's "detail" schema."""
+    pass
+
+
+def check_data(detail: dict, data):
+    """Check parsed job data against a "detail" schema. Raises JobDataError if it doesn't match."""
+    if not isinstance(data, dict):
+        raise JobDataError('Job data must be a JSON object.')
+
+    for field, spec in detail.items():
+        if field not in data:
+            if spec.get('required', True):
+                raise JobDataError('Job data is missing "{}".'.format(field))
+            continue
+        value = data[field]
+        expected = schema_types.get(spec.get('type'))
+        if expected is None:
+            continue
+        if isinstance(value, bool) and bool not in expected or not isinstance(value, expected):
+            raise JobDataError('Job data "{}" must be a{} {}.'.format(
+                field, 'n' if spec['type'][0] in 'aeiou' else '', spec['type']))
+
+
+def import_runner(path: str):
+    """Import a runner class from a dotted path. Paths starting with "." are relative to this
+    package, e.g. ".http.HTTPJobRunner"."""
+    module_path, _, class_name = path.rpartition('.')
+    module = importlib.import_module(module_path, package=__package__)
+    runner_class = getattr(module, class_name)
+    if not issubclass(runner_class, AbstractJobRunner):
+        raise TypeError('{} is not a job runner.'.format(path))
+    return runner_class
+
+
+class JobRunnerRegistry(object):
+    """In-memory map of job types to their runners."""
+
+    def __init__(self, runner_paths: dict, runner_options: dict = None):
+        """Constructor."""
+
+        # Mapping of job type name -> dotted path of its runner class
+        self.runner_paths = runner_paths
+
+        # Mapping of job type name -> keyword arguments for its runner's load_class()
+        self.runner_options = runner_options or {}
+
+        # Filled in by load()
+        self.job_types = {}
+        self.by_name = {}
+
+    async def load(self, db: DB, scheduler_queue, runners: bool = True):
+        """Load the job types from the database, adding any type which only exists in config, and
+        prepare a runner for each of them (unless `runners` is False, when the runners are loaded
+        later by the scheduler, or never in a process which doesn't run jobs itself)."""
+        runner_classes = {name: import_runner(path) for name, path in self.runner_paths.items()}
+
+        # A runner class describes the data its jobs take, so new job types can be created here,
+        # and the stored schema of a known type is brought up to date with its runner class
+        rows = await db.execute('SELECT id, name, detail FROM job_type;')
+        stored = {name: json.loads(detail or '{}') for _, name, detail in rows}
+        changed = False
+        for name, runner_class in runner_classes.items():
+            if name not in stored:
+                await db.execute('INSERT INTO job_type (id, name, detail) VALUES (NULL, ?, ?);',
+                                 name, json.dumps(runner_class.detail))
+                changed = True
+            elif stored[name] != runner_class.detail:
+                await db.execute('UPDATE job_type SET detail = ? WHERE name = ?;',
+                                 json.dumps(runner_class.detail), name)
+                changed = True
+        if changed:
+            rows = await db.execute('SELECT id, name, detail FROM job_type;')
+
+        self.job_types = {id_: JobType(id_, name, json.loads(detail or '{}'), None)
+                          for id_, name, detail in rows}
+        self.by_name = {job_type.name: job_type for job_type in self.job_types.values()}
+        if runners:
+            self.load_runners(db, scheduler_queue)
+
+    def load_runners(self, db: DB, scheduler_queue):
+        """Prepare a runner for each loaded job type. Runners hold resources (such as HTTP clients)
+        tied to the event loop this is called from, which is the loop their jobs are run on."""
+        runner_classes = {name: import_runner(path) for name, path in self.runner_paths.items()}
+        job_types = {}
+        for job_type in self.job_types.values():
+            runner = None
+            runner_class = runner_classes.get(job_type.name)
+            if runner_class is not None:
+                runner_class.load_class(db, scheduler_queue,
+                                        **self.runner_options.get(job_type.name, {}))
+                runner = runner_class()
+                runner.load()
+            job_types[job_type.id] = job_type._replace(runner=runner)
+
+        # Swapped in whole, as the API thread reads the job types while this runs
+        self.job_types = job_types
+        self.by_name = {job_type.name: job_type for job_type in self.job_types.values()}
+
+    def runner_for(self, type_id: int):
+        """The runner for a job type id, or None if the type has no runner."""
+        job_type = self.job_types.get(type_id)
+        return job_type.runner if job_type is not None else None
+
+    @staticmethod
+    def validate(job_type: JobType, data: str):
+        """Parse job data and check it against the job type's "detail" schema.
+
+        Every field in the schema is required unless it says `"required": false`. Fields which are
+        not in the schema (such as "misfire_policy") are left alone. Returns the parsed data.
+        """
+        try:
+            data = json.loads(data)
+        except ValueError:
+            raise JobDataError('Job data must be a JSON object.')
+        check_data(job_type.detail, data)
+        return data
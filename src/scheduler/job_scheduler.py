@@ -1,68 +1,172 @@
 """
 src/scheduler/job_scheduler.py
 
-Code related to running jobs, scheduling jobs, etc.
+Code related to running jobs, scheduling jobs, etc. The scheduler and the job runners have an event
+loop of their own in the scheduler thread, so bursts of due jobs and their requests never hold up
+the API's loop. The API hands jobs over with thread-safe calls.
 """
 
 import asyncio
+import random
 
 from asyncio import Queue
 from threading import Thread
-from tornado.httpclient import AsyncHTTPClient
-from tornado.platform.asyncio import to_asyncio_future
 
+from .dispatcher import Dispatcher
 from .job import Job
-from .job_runners import AbstractJobRunner, HTTPJobRunner
-from ..database import DB
+from .job_runners import AbstractJobRunner, JobRunnerRegistry
+from ..database import DB, JobLeases
 from ..utils.dates import now
-from .parser import parse
+from ..utils.metrics import metrics
+from .parser import compile_schedule
+
+
+fire_lag_seconds = metrics.histogram('veggiecron_job_fire_lag_seconds',
+                                     'Seconds between when jobs were due and when they fired.')
+jobs_fired = metrics.counter('veggiecron_jobs_fired', 'Job runs started.')
+claims_lost = metrics.counter('veggiecron_job_claims_lost',
+                              'Due jobs not fired because another scheduler had claimed them.')
 
 
 class JobScheduler(Thread):
-    """A separate thread from the main process which runs and schedules jobs."""
+    """A separate thread from the main process which runs and schedules jobs, on its own event
+    loop."""
+
+    # Number of seconds between each wake up of the dispatcher
+    tick = 0.1
+
+    # What to do with a job which missed one or more runs (job data "misfire_policy")
+    misfire_policies = ('fire_once', 'fire_all', 'skip')
 
-    def __init__(self, work_queue: Queue, db: DB, event_loop):
+    def __init__(self, db: DB, registry: JobRunnerRegistry, window: float = 0,
+                 misfire_grace: float = 1, catchup_window: float = 60, catchup_jitter: float = 0.5,
+                 max_catchup_fires: int = 100, shards: int = 0, owned_shards=(),
+                 lease_seconds: float = 60, use_uvloop: bool = False):
         """Constructor."""
 
-        # Bind the work_queue to the thread
-        self.work_queue = work_queue
+        # Jobs waiting to be scheduled. Created on the scheduler's loop once the thread starts.
+        self.work_queue = None
 
-        # Bind the database connection to the thread
+        # Bind the database connection to the thread. It can be used from any thread's loop.
         self.db = db
 
-        # Bind the event loop to the thread
-        self.event_loop = event_loop
+        # The thread's own event loop, which the scheduler and the job runners run on
+        self.event_loop = self.new_event_loop(use_uvloop)
 
-        # Prepare all job runners
-        HTTPJobRunner.load_class(db, work_queue)
+        # Every scheduled job waits in the dispatcher until it is due. The dispatcher runs on the
+        # event loop's monotonic clock, so a jump of the wall clock doesn't move the pending runs.
+        self.dispatcher = Dispatcher(tick=self.tick)
 
-        # Call the parent (Thread) constructor
-        super().__init__()
+        # Mapping of job id -> the current version of every job scheduled or running. A job handed
+        # back by its runner after it was changed, paused or deleted is no longer current, and is
+        # dropped instead of being scheduled again.
+        self.jobs = {}
 
-    def run(self):
-        """Main function of this thread."""
+        # When set, only jobs due in the next `window` seconds are held in memory. Everything due
+        # before `horizon` has been loaded, the rest waits in the database until the window moves.
+        self.window = window
+        self.horizon = None
+
+        # Next run times worked out for jobs dropped past the horizon, waiting to be saved as
+        # (next run at, job id, date updated)
+        self._unsaved_runs = []
+
+        # A job is misfired when it is more than `misfire_grace` seconds overdue. Misfired jobs
+        # found at startup are spread over `catchup_window` seconds (at most the window), plus up
+        # to `catchup_jitter` of the spacing between them, instead of all firing at once.
+        self.misfire_grace = misfire_grace
+        self.catchup_window = catchup_window
+        if window and catchup_window > window:
+            self << 'scheduler.catchup_window_seconds is longer than window_seconds, using {}.' \
+                .format(window)
+            self.catchup_window = window
+        self.catchup_jitter = catchup_jitter
+        self.max_catchup_fires = max_catchup_fires
+        self._catchup_spacing = 0.0
+        self._catchup_until = 0.0
+        self._catchup_next = 0.0
+
+        # Mapping of job types to job runners. The job types are loaded before the thread is
+        # started, the runners by the thread itself so they belong to its loop.
+        self.registry = registry
 
-        self.setName('Thread-JobScheduler')
+        # When jobs are split into `shards` shards (by job id), this scheduler only runs the jobs
+        # of the shards it owns
+        self.shards = shards
+        self.owned_shards = set(owned_shards)
+
+        # A job's lease is taken before each run, so other schedulers sharing the database never
+        # fire the same run
+        self.leases = JobLeases(db, lease_seconds)
+
+        metrics.gauge('veggiecron_work_queue_depth', 'Jobs waiting to be scheduled.') \
+            .set_function(lambda: self.work_queue.qsize() if self.work_queue is not None else 0)
+        metrics.gauge('veggiecron_scheduled_jobs', 'Jobs held in memory until they are due.') \
+            .set_function(self.dispatcher.__len__)
+
+        # Call the parent (Thread) constructor. A daemon, so it never keeps the process alive.
+        super().__init__(name='Thread-JobScheduler', daemon=True)
+
+    @classmethod
+    def from_config(cls, server_config, db: DB, registry: JobRunnerRegistry, owned_shards=()):
+        """Create a scheduler tuned by the "scheduler" section of config.yaml."""
+        return cls(db, registry,
+                   window=server_config.scheduler_window,
+                   misfire_grace=server_config.scheduler_misfire_grace,
+                   catchup_window=server_config.scheduler_catchup_window,
+                   catchup_jitter=server_config.scheduler_catchup_jitter,
+                   max_catchup_fires=server_config.scheduler_max_catchup_fires,
+                   shards=server_config.scheduler_shards, owned_shards=owned_shards,
+                   lease_seconds=server_config.scheduler_lease_seconds,
+                   use_uvloop=server_config.scheduler_uvloop)
+
+    @classmethod
+    def new_event_loop(cls, use_uvloop: bool):
+        """A new event loop for the thread: uvloop's, when asked for and installed."""
+        if use_uvloop:
+            try:
+                import uvloop
+                return uvloop.new_event_loop()
+            except ImportError:
+                print('[JobScheduler] uvloop is not installed, using the asyncio event loop.')
+        return asyncio.new_event_loop()
+
+    def run(self):
+        """Main function of this thread. Runs the scheduler's event loop until stop() is called."""
 
-        # Create the event loop
+        # Make the event loop this thread's own
         asyncio.set_event_loop(self.event_loop)
+        self.work_queue = Queue()
 
         async def main():
 
-            # Create an asynchronous http client
-            # TODO: Possible method of speeding up the http client?
-            http_client = AsyncHTTPClient(max_clients=50)
+            # The runners (and their HTTP clients) are created here, on the scheduler's loop
+            self.registry.load_runners(self.db, self.work_queue)
 
-            # First time this thread is run, find all jobs which are not complete and reschedule
-            # them.
-            query_result = await self.db.execute("SELECT * FROM job WHERE done = 0;")
-            for row in query_result:
-                await self.work_queue.put(Job(*row))
+            # Runs cut short by a scheduler going down are fired again once their lease runs out
+            time_now = now(as_utc=True)
+            interrupted = await self.leases.count_expired(time_now)
+            if interrupted:
+                self << '{} job runs were interrupted, they will be run again.'.format(interrupted)
+
+            # Count the jobs which missed their run while the server was down, to pace the catch up
+            shard_sql, shard_args = self.shard_filter()
+            overdue = await self.db.execute(
+                "SELECT COUNT(*) FROM job WHERE done = 0 AND paused = 0 AND next_run_at < ?"
+                + shard_sql + ";", time_now - self.misfire_grace, *shard_args)
+            overdue = overdue[0][0]
+            if overdue and self.catchup_window > 0:
+                self << '{} jobs are behind schedule, catching up over {:.0f} seconds'.format(
+                    overdue, self.catchup_window)
+                self._catchup_spacing = self.catchup_window / overdue
+                self._catchup_until = time_now + self.catchup_window
 
-            # Create a mapping of job types to job runners
-            job_runners = {
-                1: HTTPJobRunner(),
-            }
+            # First time this thread is run, find all jobs which are not complete and reschedule
+            # them
+            if self.window:
+                self.horizon = time_now + self.window
+                asyncio.ensure_future(self.refill())
+            await self.load_jobs()
 
             # Process jobs from the work queue
             while True:
@@ -73,30 +177,307 @@ class JobScheduler(Thread):
                 if job is False:
                     break
 
+                # Jobs which have since been changed or cancelled are dropped
+                if self.jobs.get(job.id) is not job:
+                    self.work_queue.task_done()
+                    continue
+
+                # Jobs of shards which were handed to another scheduler are dropped
+                if not self.owns(job.id):
+                    self.cancel_now(job.id)
+                    self.work_queue.task_done()
+                    continue
+
                 # If the job doesn't have a last_ran time, use the date_created time
                 if job.last_ran is None:
                     job.last_ran = float(job.date_created)
 
-                # Calculate the job's next run time
-                next_run = parse(job.schedule, job.last_ran)
+                # Calculate the job's next run time. Runs still owed from a "fire_all" catch up come
+                # first, paced by the catch up ramp.
+                stored_next_run = job.next_run_at
+                time_now = now(as_utc=True)
+                if job.catchup_remaining > 0:
+                    job.catchup_remaining -= 1
+                    next_run = self.catchup_slot(time_now)
+                else:
+                    next_run = compile_schedule(job.schedule).next_after(job.last_ran)
+                    if next_run < time_now - self.misfire_grace:
+                        next_run = self.misfired(job, next_run, time_now)
+                job.next_run_at = next_run
 
-                # Get the appropriate job runner
-                job_runner = job_runners.get(job.type_id)
-                ":type: AbstractJobRunner"
+                # Jobs beyond the horizon stay in the database until the window reaches them. The
+                # window only loads jobs by their stored next run time, so it is saved first
+                # unless it is already there (it isn't for jobs created before it was stored, or
+                # moved by a misfire policy). Jobs owing "fire_all" runs stay, as only memory holds
+                # how many they owe.
+                if self.horizon is not None and next_run >= self.horizon and \
+                        not job.catchup_remaining:
+                    if next_run != stored_next_run:
+                        self.save_next_run(job)
+                    self.cancel_now(job.id)
+                    self.work_queue.task_done()
+                    continue
 
-                # Schedule the job to run
-                if next_run <= now():
+                # Hand the job to the dispatcher, which fires it once it is due
+                if next_run <= time_now:
                     self << 'Job "{}" is behind schedule! Running now!'.format(job.name)
-                    asyncio.ensure_future(job_runner.run(job, 0))
                 else:
-                    seconds = next_run.timestamp() - now().timestamp()
-                    self << 'Scheduling job "{}" to run in {:.2f} seconds'.format(job.name, seconds)
-                    asyncio.ensure_future(job_runner.run(job, seconds))
+                    self << 'Scheduling job "{}" to run in {:.2f} seconds'.format(
+                        job.name, next_run - time_now)
+                self.dispatcher.push(self.loop_time(next_run, time_now), job, key=job.id)
 
                 # Job has been scheduled, move on to scheduling the next job
                 self.work_queue.task_done()
 
-        asyncio.ensure_future(to_asyncio_future(main()))
+        self.event_loop.create_task(main())
+        self.event_loop.create_task(self.dispatch())
+        self.event_loop.run_forever()
+
+    def stop(self):
+        """Stop the scheduler's event loop, ending the thread. Safe to call from any thread."""
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+
+    def misfired(self, job: Job, next_run: float, time_now: float):
+        """Apply the job's misfire policy to a run it missed, returning when it should fire."""
+        policy = job.data.get('misfire_policy', 'fire_once') if isinstance(job.data, dict) else None
+        if policy not in self.misfire_policies or job.run_once:
+            policy = 'fire_once'
+
+        if policy == 'fire_once':
+            return self.catchup_slot(time_now)
+
+        # Walk the schedule forward over the runs that were missed
+        schedule = compile_schedule(job.schedule)
+        missed = 0
+        while next_run <= time_now and missed < self.max_catchup_fires:
+            missed += 1
+            next_run = schedule.next_after(next_run)
+
+        if policy == 'skip':
+            if next_run <= time_now:
+                next_run = schedule.next_after(time_now)
+            self << 'Job "{}" missed {} runs, skipping them.'.format(job.name, missed)
+            return next_run
+
+        # "fire_all": fire now, and once more for each of the other missed runs
+        self << 'Job "{}" missed {} runs, firing all of them.'.format(job.name, missed)
+        job.catchup_remaining = missed - 1
+        return self.catchup_slot(time_now)
+
+    def catchup_slot(self, time_now: float):
+        """Fire time for an overdue run. During the startup catch up, runs are paced and
+        jittered."""
+        if time_now >= self._catchup_until:
+            return time_now
+        slot = max(self._catchup_next, time_now)
+        self._catchup_next = slot + self._catchup_spacing
+        return slot + random.uniform(0, self.catchup_jitter * self._catchup_spacing)
+
+    async def dispatch(self):
+        """Wake up once per tick and fire every job which is due, in one batch."""
+        asyncio.ensure_future(self.renew_leases())
+        while True:
+            due = self.dispatcher.pop_due(self.event_loop.time())
+            if due:
+                await self.fire(due)
+            await asyncio.sleep(self.tick)
+
+    async def fire(self, due):
+        """Claim the leases of a batch of due jobs and run the jobs claimed."""
+        time_now = now(as_utc=True)
+        claimed = await self.leases.claim([(job.id, job.last_ran) for job in due], time_now)
+        lost = []
+        for job in due:
+            if job.id not in claimed:
+                lost.append(job)
+                continue
+            fire_lag_seconds.observe(max(0.0, time_now - job.next_run_at))
+            jobs_fired.inc()
+            if job.run_once:
+                self.jobs.pop(job.id, None)
+
+            # Get the appropriate job runner
+            job_runner = self.registry.runner_for(job.type_id)
+            ":type: AbstractJobRunner"
+            if job_runner is None:
+                self << 'Job "{}" has no runner for its type!'.format(job.name)
+                await self.leases.release(job.id)
+                continue
+
+            try:
+                job_runner.run(job)
+            except Exception as e:
+                self << 'Job "{}" failed to start: {}'.format(job.name, e)
+                await self.leases.release(job.id)
+
+                # Try again at the job's next scheduled time. Its last run time is left alone, as
+                # the lease is only claimed for a job which hasn't run since it was scheduled.
+                if not job.run_once:
+                    job.next_run_at = compile_schedule(job.schedule).next_after(time_now)
+                    self.dispatcher.push(self.loop_time(job.next_run_at, time_now), job,
+                                         key=job.id)
+
+        if lost:
+            claims_lost.inc(len(lost))
+            await self.reschedule_lost(lost)
+
+    async def reschedule_lost(self, jobs):
+        """Deal with jobs another scheduler claimed first, or ran since they were scheduled here.
+
+        A job still being run elsewhere is tried again when that lease runs out, in case its
+        scheduler died. Otherwise the job is reloaded and scheduled from its latest run.
+        """
+        time_now = now(as_utc=True)
+        jobs = {job.id: job for job in jobs}
+        ids = list(jobs)
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows = await self.db.execute(
+                'SELECT * FROM job WHERE id IN ({});'.format(', '.join('?' * len(batch))), *batch)
+            for row in rows:
+                latest = Job(*row)
+                if latest.done or latest.paused:
+                    self.cancel_now(latest.id)
+                elif latest.lease_owner not in (None, self.leases.owner) and \
+                        latest.lease_expires > time_now:
+                    self.dispatcher.push(self.loop_time(latest.lease_expires, time_now),
+                                         jobs[latest.id], key=latest.id)
+                else:
+                    self.queue_job(latest)
+
+    async def renew_leases(self):
+        """Keep the leases of the jobs running here from running out."""
+        while True:
+            await asyncio.sleep(self.leases.lease_seconds / 3)
+            try:
+                await self.leases.renew(now(as_utc=True))
+            except Exception as e:
+                self << 'Could not renew leases: {}'.format(e)
+
+    async def refill(self):
+        """Slide the window forward, loading the jobs which have come within the horizon."""
+        while True:
+            await asyncio.sleep(self.window / 4)
+
+            # Move the horizon before querying, so a job re-queued while the query runs is kept in
+            # memory rather than missed. The dispatcher is keyed by job id, so loading it twice is
+            # harmless.
+            old_horizon = self.horizon
+            self.horizon = now(as_utc=True) + self.window
+            shard_sql, shard_args = self.shard_filter()
+            rows = self.db.stream(
+                "SELECT * FROM job WHERE done = 0 AND paused = 0 AND next_run_at >= ? "
+                "AND next_run_at < ?" + shard_sql + ";", old_horizon, self.horizon, *shard_args)
+            async for row in rows:
+                self.queue_job(Job(*row))
+
+    def save_next_run(self, job: Job):
+        """Store the next run time of a job, in batches. Runs on the scheduler's loop."""
+        self._unsaved_runs.append((job.next_run_at, job.id, job.date_updated))
+        if len(self._unsaved_runs) >= 500 or self.work_queue.empty():
+            runs, self._unsaved_runs = self._unsaved_runs, []
+            asyncio.ensure_future(self.save_next_runs(runs))
+
+    async def save_next_runs(self, runs):
+        """Write a batch of next run times, skipping jobs changed since they were loaded."""
+        def write_runs(connection, runs_):
+            connection.executemany('UPDATE job SET next_run_at = ? WHERE id = ? '
+                                   'AND date_updated = ?;', runs_)
+            connection.commit()
+
+        try:
+            await self.db.run_in_writer(write_runs, runs)
+        except Exception as e:
+            self << 'Could not save the next run of {} jobs: {!r}'.format(len(runs), e)
+
+    async def load_jobs(self, shards=None):
+        """Queue every job which is not complete (of the given shards, or of every owned shard). In
+        windowed mode only the jobs due before the horizon are loaded."""
+        shard_sql, shard_args = self.shard_filter(shards)
+        if self.window:
+            rows = self.db.stream(
+                "SELECT * FROM job WHERE done = 0 AND paused = 0 "
+                "AND (next_run_at IS NULL OR next_run_at < ?)" + shard_sql + ";",
+                self.horizon, *shard_args)
+        else:
+            rows = self.db.stream("SELECT * FROM job WHERE done = 0 AND paused = 0"
+                                  + shard_sql + ";", *shard_args)
+        async for row in rows:
+            self.queue_job(Job(*row))
+
+    async def submit(self, job: Job):
+        """Hand a new (or changed) job to the scheduler from another thread (such as the API's). It
+        replaces any older version of the job, and a paused or finished job is cancelled instead."""
+        self.event_loop.call_soon_threadsafe(self.queue_job, job)
+
+    async def submit_many(self, jobs):
+        """Hand a batch of new jobs to the scheduler from another thread, in one handoff."""
+        self.event_loop.call_soon_threadsafe(self.queue_jobs, list(jobs))
+
+    async def cancel(self, job_id: int):
+        """Stop scheduling a job (paused or deleted) from another thread. A run already in flight
+        is left to finish, but the job isn't scheduled again afterwards."""
+        self.event_loop.call_soon_threadsafe(self.cancel_now, job_id)
+
+    def queue_job(self, job: Job):
+        """Put a job on the work queue to be scheduled. Runs on the scheduler's loop."""
+        if job.done or job.paused:
+            self.cancel_now(job.id)
+            return
+        self.jobs[job.id] = job
+        self.work_queue.put_nowait(job)
+
+    def queue_jobs(self, jobs):
+        """Put a batch of jobs on the work queue. Runs on the scheduler's loop."""
+        for job in jobs:
+            self.queue_job(job)
+
+    def cancel_now(self, job_id: int):
+        """Forget a job, whether it is waiting in the dispatcher or running. Runs on the scheduler's
+        loop."""
+        self.dispatcher.discard(job_id)
+        self.jobs.pop(job_id, None)
+
+    def worker_metrics(self):
+        """Snapshots of the metrics of other processes running jobs. None, the scheduler runs in
+        this process."""
+        return []
+
+    def owns(self, job_id: int):
+        """Is the job in one of the shards run by this scheduler?"""
+        return not self.shards or job_id % self.shards in self.owned_shards
+
+    def shard_filter(self, shards=None):
+        """SQL condition, and its arguments, limiting a job query to the given (or owned) shards."""
+        if not self.shards:
+            return '', ()
+        shards = sorted(self.owned_shards if shards is None else shards)
+        return (' AND id % {} IN ({})'.format(int(self.shards), ', '.join('?' * len(shards))),
+                tuple(shards))
+
+    async def adopt_shard(self, shard: int):
+        """Start running the jobs of another shard."""
+        if shard in self.owned_shards:
+            return
+        self << 'Adopting shard {}.'.format(shard)
+        self.owned_shards.add(shard)
+        await self.load_jobs({shard})
+
+    def release_shard(self, shard: int):
+        """Stop running the jobs of a shard."""
+        self << 'Releasing shard {}.'.format(shard)
+        self.owned_shards.discard(shard)
+        for job_id in list(self.jobs):
+            if job_id % self.shards == shard:
+                self.cancel_now(job_id)
+
+    def loop_time(self, timestamp: float, time_now: float):
+        """The event loop's (monotonic) time at a UTC timestamp."""
+        return self.event_loop.time() + (timestamp - time_now)
+
+    def due_within(self, seconds: float):
+        """Number of scheduled jobs which will fire in the next `seconds` seconds."""
+        return self.dispatcher.due_within(seconds, self.event_loop.time())
 
     def __lshift__(self, msg):
         """Helper function for printing a message."""
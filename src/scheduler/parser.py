@@ -2,11 +2,16 @@
 src/scheduler/parser.py
 
 Parse job schedule strings into date of next job execution.
+
+Schedule strings are compiled once into small immutable schedule objects (cached by string), which
+work in plain UTC timestamps so the next run of a job can be calculated cheaply on every run.
 """
 
+from collections import namedtuple
 from datetime import timedelta
+from functools import lru_cache
 
-from ..utils.dates import utc_to_date
+from ..utils.dates import local_date, local_time, local_timestamp, utc_to_date
 
 
 schedule_string_syntax = """
@@ -17,7 +22,14 @@ Schedule string must be one of the following formats:
   * "every 10 seconds"
   * "every day @ 13:00"
   * "every 30 days @ 7:30"
-  * "once @ <utc-timestamp>" """
+  * "once @ <utc-timestamp>"
+  * "cron <minute> <hour> <day> <month> <weekday>" (or "cron <second> <minute> ...")"""
+
+cron_syntax = """
+A cron schedule has 5 fields (minute hour day month weekday) or 6 (second first), e.g.
+"cron 15 9 * * mon-fri" or "cron 0 */5 * * * *". Each field is "*", a number, a range "a-b" or
+a list "a,b", and "*" or a range may be followed by a step "/n". Months and weekdays may be named
+(jan, mon). "@hourly", "@daily", "@weekly", "@monthly" and "@yearly" may replace the fields."""
 
 
 class ParseError(ValueError):
@@ -25,65 +37,305 @@ class ParseError(ValueError):
     pass
 
 
-def parse(schedule_string: str, last_ran: float):
-    """Parse a schedule string into a Python datetime of next scheduled execution."""
+class IntervalSchedule(namedtuple('IntervalSchedule', ('source', 'seconds'))):
+    """Run every N seconds, counted from the last run."""
+    __slots__ = ()
+    run_once = False
 
-    assert isinstance(schedule_string, str)
-    assert isinstance(last_ran, float)
-    last_ran = utc_to_date(last_ran)
+    def next_after(self, last_ran: float):
+        """UTC timestamp of the next run, given the UTC timestamp of the last run."""
+        return last_ran + self.seconds
+
+    def next_after_many(self, timestamps):
+        """Next run for each of the given last run timestamps."""
+        seconds = self.seconds
+        return [last_ran + seconds for last_ran in timestamps]
+
+
+class DailySchedule(namedtuple('DailySchedule', ('source', 'days', 'hour', 'minute'))):
+    """Run every N days at a set time of day (in the server's timezone)."""
+    __slots__ = ()
+    run_once = False
+
+    def _next_for_date(self, date):
+        """UTC timestamp of this schedule's time of day, N days after the given date."""
+        day = date + timedelta(days=self.days)
+        return local_timestamp(day.year, day.month, day.day, self.hour, self.minute)
+
+    def next_after(self, last_ran: float):
+        """UTC timestamp of the next run, given the UTC timestamp of the last run."""
+        return self._next_for_date(local_date(last_ran))
+
+    def next_after_many(self, timestamps):
+        """Next run for each of the given last run timestamps.
+
+        Jobs which last ran on the same day share the same next run, so each date is only
+        calculated once.
+        """
+        by_date = {}
+        next_runs = []
+        for last_ran in timestamps:
+            date = local_date(last_ran)
+            next_run = by_date.get(date)
+            if next_run is None:
+                next_run = by_date[date] = self._next_for_date(date)
+            next_runs.append(next_run)
+        return next_runs
+
+
+def next_bit(mask: int, start: int):
+    """Lowest value >= start in a bitset, or None."""
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+
+class CronSchedule(namedtuple('CronSchedule', ('source', 'seconds', 'minutes', 'hours', 'days',
+                                               'months', 'weekdays', 'any_day', 'any_weekday'))):
+    """Run whenever the clock (in the server's timezone) matches a cron expression.
+
+    Each field is compiled into a bitset of the values it matches (bit N set = value N matches), so
+    finding the next run jumps straight to the next matching month, day, hour, minute and second
+    instead of stepping through every minute.
+    """
+    __slots__ = ()
+    run_once = False
+
+    # A run is looked for this many days ahead at most. Every expression which compiles fires at
+    # least once every 8 years (February 29th).
+    max_days = 366 * 9
+
+    def day_matches(self, day):
+        """Does the date match the day and weekday fields? Like cron, when neither field starts
+        with "*" a date matching either one is enough."""
+        day_of_month = (self.days >> day.day) & 1
+        weekday = (self.weekdays >> (day.weekday() + 1) % 7) & 1
+        if self.any_day or self.any_weekday:
+            return day_of_month and weekday
+        return day_of_month or weekday
+
+    def next_time(self, hour: int, minute: int, second: int):
+        """First matching time of day at or after the given one, or None."""
+        while True:
+            if second > 59:
+                minute, second = minute + 1, 0
+            if minute > 59:
+                hour, minute = hour + 1, 0
+            next_hour = next_bit(self.hours, hour)
+            if next_hour is None:
+                return None
+            if next_hour != hour:
+                hour, minute, second = next_hour, 0, 0
+            next_minute = next_bit(self.minutes, minute)
+            if next_minute is None:
+                hour, minute, second = hour + 1, 0, 0
+                continue
+            if next_minute != minute:
+                minute, second = next_minute, 0
+            next_second = next_bit(self.seconds, second)
+            if next_second is None:
+                minute, second = minute + 1, 0
+                continue
+            return hour, minute, next_second
+
+    def next_after(self, last_ran: float):
+        """UTC timestamp of the next run, given the UTC timestamp of the last run."""
+        day, seconds = local_time(last_ran)
+        hour, seconds = divmod(int(seconds), 3600)
+        minute, second = divmod(seconds, 60)
+        second += 1
+        last_day = day + timedelta(days=self.max_days)
+
+        while day <= last_day:
+
+            # Skip whole months which don't match
+            if not (self.months >> day.month) & 1:
+                month = next_bit(self.months, day.month + 1)
+                if month is None:
+                    day = day.replace(year=day.year + 1, month=next_bit(self.months, 1), day=1)
+                else:
+                    day = day.replace(month=month, day=1)
+                hour = minute = second = 0
+                continue
+
+            if self.day_matches(day):
+                time_of_day = self.next_time(hour, minute, second)
+                if time_of_day is not None:
+                    hour, minute, second = time_of_day
+                    next_run = local_timestamp(day.year, day.month, day.day, hour, minute) + second
+                    if next_run > last_ran:
+                        return next_run
+
+                    # Only when the clocks go back: look again from the following second
+                    second += 1
+                    continue
+
+            day += timedelta(days=1)
+            hour = minute = second = 0
+
+        raise ParseError('Schedule "{}" never fires.'.format(self.source))
+
+    def next_after_many(self, timestamps):
+        """Next run for each of the given last run timestamps."""
+        return [self.next_after(last_ran) for last_ran in timestamps]
+
+
+class OnceSchedule(namedtuple('OnceSchedule', ('source', 'timestamp'))):
+    """Run one time only, at a set UTC timestamp."""
+    __slots__ = ()
+    run_once = True
+
+    def next_after(self, last_ran: float):
+        """UTC timestamp of the (only) run."""
+        return self.timestamp
+
+    def next_after_many(self, timestamps):
+        """Next run for each of the given last run timestamps."""
+        return [self.timestamp] * len(timestamps)
+
+
+# Number of seconds in each unit of an "every" schedule
+unit_seconds = {
+    'second': 1, 'seconds': 1,
+    'minute': 60, 'minutes': 60,
+    'hour': 3600, 'hours': 3600,
+}
+day_units = ('day', 'days')
+
+# Lowest value, highest value and names of each cron field
+cron_fields = (
+    ('second', 0, 59, {}),
+    ('minute', 0, 59, {}),
+    ('hour', 0, 23, {}),
+    ('day', 1, 31, {}),
+    ('month', 1, 12, {name: number for number, name in enumerate(
+        ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}),
+    ('weekday', 0, 7, {name: number for number, name in enumerate(
+        ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))}),
+)
+cron_macros = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
 
-    units = ('day', 'days', 'hour', 'hours', 'minute', 'minutes', 'second', 'seconds')
-    digit = None
-    unit = None
+# Number of days in each month, in a leap year
+month_days = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
 
-    pieces = schedule_string.split(' ')
+
+def parse_cron_field(text: str, low: int, high: int, names: dict):
+    """Compile one cron field into a bitset of the values it matches. Raises ParseError."""
+
+    def value(part):
+        part = part.lower()
+        if part in names:
+            return names[part]
+        if not part.isdigit():
+            raise ParseError(cron_syntax)
+        return int(part)
+
+    mask = 0
+    for part in text.split(','):
+        range_, slash, step = part.partition('/')
+        if slash and not step.isdigit():
+            raise ParseError(cron_syntax)
+        step = int(step) if slash else 1
+        if range_ == '*':
+            start, end = low, high
+        else:
+            start, dash, end = range_.partition('-')
+            start = value(start)
+            end = value(end) if dash else (high if slash else start)
+        if step < 1 or not low <= start <= end <= high:
+            raise ParseError(cron_syntax)
+        for number in range(start, end + 1, step):
+            mask |= 1 << number
+    return mask
+
+
+def compile_cron(schedule_string: str, expression: list):
+    """Compile the fields of a cron schedule. Raises ParseError."""
+    if len(expression) == 1 and expression[0] in cron_macros:
+        expression = cron_macros[expression[0]].split()
+    if len(expression) == 5:
+        expression = ['0'] + expression
+    if len(expression) != 6:
+        raise ParseError(cron_syntax)
+
+    seconds, minutes, hours, days, months, weekdays = (
+        parse_cron_field(text, low, high, names)
+        for text, (_, low, high, names) in zip(expression, cron_fields))
+
+    # Sunday is both 0 and 7
+    if weekdays & (1 << 7):
+        weekdays = (weekdays | 1) & ~(1 << 7)
+
+    any_day = expression[3].startswith('*')
+    any_weekday = expression[5].startswith('*')
+
+    # A day of the month which no chosen month has (such as February 30th) would never fire
+    if any_weekday and not any_day and not any(
+            next_bit(days, 1) is not None and next_bit(days, 1) <= month_days[month]
+            for month in range(1, 13) if (months >> month) & 1):
+        raise ParseError('Schedule "{}" never fires.'.format(schedule_string))
+
+    return CronSchedule(schedule_string, seconds, minutes, hours, days, months, weekdays,
+                        any_day, any_weekday)
+
+
+@lru_cache(maxsize=4096)
+def compile_schedule(schedule_string: str):
+    """Validate a schedule string and compile it into a schedule object. Raises ParseError."""
+
+    if not isinstance(schedule_string, str):
+        raise ParseError(schedule_string_syntax)
+
+    pieces = schedule_string.split()
     if len(pieces) < 2:
         raise ParseError(schedule_string_syntax)
 
     if pieces[0] == 'every':
 
-        if len(pieces) == 2:
-            digit = 1
-            unit = pieces[1]
-
-        if len(pieces) == 3:
-            try:
-                digit = int(pieces[1])
-                unit = pieces[2]
-            except ValueError:
-                raise ParseError(schedule_string_syntax)
-
-        if unit not in units:
+        # "every <unit>" or "every <digit> <unit>", optionally followed by "@ <time>"
+        digit = 1
+        rest = pieces[1:]
+        if rest[0].isdigit():
+            digit = int(rest[0])
+            rest = rest[1:]
+        if not rest or digit < 1:
             raise ParseError(schedule_string_syntax)
+        unit = rest[0]
 
-        if unit in ('day', 'days'):
-
-            if '@' in schedule_string and len(pieces) >= 4:
-                time = pieces[3].strip()
+        if unit in day_units:
 
-            else:
+            if len(rest) == 1:
                 time = '00:00'  # Run at midnight if no "@ <time>" is specified
+            elif len(rest) == 3 and rest[1] == '@':
+                time = rest[2]
+            else:
+                raise ParseError(schedule_string_syntax)
 
             try:
-                hour, minute = (int(time[:2]), int(time[-2:]))
+                hour, minute = (int(part) for part in time.split(':'))
             except ValueError:
                 raise ParseError(schedule_string_syntax)
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ParseError(schedule_string_syntax)
 
-            next_run = last_ran + timedelta(days=+digit)
-            next_run.hour = hour
-            next_run.minute = minute
-            next_run.second = 0
-
-            return next_run
+            return DailySchedule(schedule_string, digit, hour, minute)
 
-        if unit in ('hour', 'hours'):
-            return last_ran + timedelta(hours=+digit)
+        if unit in unit_seconds and len(rest) == 1:
+            return IntervalSchedule(schedule_string, float(digit * unit_seconds[unit]))
 
-        if unit in ('minute', 'minutes'):
-            return last_ran + timedelta(minutes=+digit)
+        raise ParseError(schedule_string_syntax)
 
-        if unit in ('second', 'seconds'):
-            return last_ran + timedelta(seconds=+digit)
+    elif pieces[0] == 'cron':
+        return compile_cron(schedule_string, pieces[1:])
 
     elif pieces[0] == 'once':
 
@@ -91,11 +343,18 @@ def parse(schedule_string: str, last_ran: float):
             raise ParseError(schedule_string_syntax)
 
         try:
-            time_to_run = utc_to_date(float(pieces[2]))
+            return OnceSchedule(schedule_string, float(pieces[2]))
         except ValueError:
             raise ParseError(schedule_string_syntax)
 
-        return time_to_run
-
     else:
         raise ParseError(schedule_string_syntax)
+
+
+def parse(schedule_string: str, last_ran: float):
+    """Parse a schedule string into a Python datetime of next scheduled execution."""
+
+    assert isinstance(schedule_string, str)
+    assert isinstance(last_ran, float)
+
+    return utc_to_date(compile_schedule(schedule_string).next_after(last_ran))
@@ -0,0 +1,248 @@
+"""
+src/scheduler/shards.py
+
+Runs the scheduler in several worker processes, so firing jobs isn't limited to one core. Jobs are
+split into shards by id (`job.id % shards`) and every shard is owned by one worker, which loads,
+schedules and runs only that shard's jobs and writes the results to the shared database. The API
+process keeps a ShardSupervisor in place of a scheduler: it routes new jobs to the worker owning
+their shard, and replaces a worker which died, sharing its shards out again. The workers send it
+their metrics, which "/metrics" adds to the API process' own.
+"""
+
+import asyncio
+import multiprocessing
+
+from queue import Empty
+
+from .job import Job
+from .job_scheduler import JobScheduler
+from .job_runners import JobRunnerRegistry
+from ..database import DB
+from ..utils.dates import set_timezone
+from ..utils.metrics import metrics
+
+
+# Workers are started fresh rather than forked, so they don't inherit the API process' event loop,
+# threads and database connections
+_context = multiprocessing.get_context('spawn')
+
+
+def run_worker(worker_id: int, owned_shards, server_config, inbox, outbox,
+               report_interval: float = 1):
+    """Entry point of a worker process. Runs a scheduler for the owned shards until told to stop,
+    putting a snapshot of its metrics in `outbox` every `report_interval` seconds.
+
+    Messages from the supervisor are read from `inbox`:
+        ('job', job_id)     load the job from the database and schedule it
+        ('jobs', job_ids)   the same for a batch of jobs
+        ('cancel', job_id)  stop scheduling a paused or deleted job
+        ('adopt', shard)    start running the jobs of a shard
+        ('release', shard)  stop running the jobs of a shard
+        ('stop',)           end the process
+    """
+    set_timezone(server_config.timezone)
+
+    db = DB(server_config.db_file,
+            commit_batch_size=server_config.db_commit_batch_size,
+            commit_window=server_config.db_commit_window,
+            read_pool_size=server_config.db_read_pool_size,
+            wal=server_config.db_wal)
+    registry = JobRunnerRegistry(server_config.job_runners, server_config.runner_options)
+    scheduler = JobScheduler.from_config(server_config, db, registry, owned_shards)
+
+    async def submit(job_ids):
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            rows = await db.execute('SELECT * FROM job WHERE id IN ({});'.format(
+                ', '.join('?' * len(chunk))), *chunk)
+            scheduler.queue_jobs([Job(*row) for row in rows])
+
+    # Runs on the scheduler's loop
+    def handle(message):
+        if message[0] == 'job':
+            asyncio.ensure_future(submit([message[1]]))
+        elif message[0] == 'jobs':
+            asyncio.ensure_future(submit(message[1]))
+        elif message[0] == 'cancel':
+            scheduler.cancel_now(message[1])
+        elif message[0] == 'adopt':
+            asyncio.ensure_future(scheduler.adopt_shard(message[1]))
+        elif message[0] == 'release':
+            scheduler.release_shard(message[1])
+
+    async def report_metrics():
+        while True:
+            outbox.put(('metrics', worker_id, metrics.snapshot()))
+            await asyncio.sleep(report_interval)
+
+    print('[ShardWorker {}] Running shards {}.'.format(worker_id, sorted(owned_shards)))
+    # The job types are loaded here, the runners by the scheduler on its own loop
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(registry.load(db, None, runners=False))
+    loop.close()
+    scheduler.start()
+    scheduler.event_loop.call_soon_threadsafe(asyncio.ensure_future, report_metrics())
+
+    # The scheduler runs in its own thread, this one hands it the supervisor's messages
+    try:
+        while True:
+            message = inbox.get()
+            if message[0] == 'stop':
+                break
+            scheduler.event_loop.call_soon_threadsafe(handle, message)
+    finally:
+        scheduler.stop()
+        scheduler.join(timeout=5)
+        db.close()
+
+        # Metrics not yet read by the supervisor don't need to hold up the exit
+        outbox.cancel_join_thread()
+
+
+class ShardSupervisor(object):
+    """Starts the scheduler worker processes and keeps every shard owned by a live worker."""
+
+    # Number of seconds between each check on the workers
+    check_interval = 1
+
+    def __init__(self, server_config):
+        """Constructor."""
+        self.server_config = server_config
+        self.shards = server_config.scheduler_shards
+
+        # Mapping of worker id -> (process, inbox queue)
+        self.workers = {}
+
+        # Mapping of shard -> id of the worker which owns it
+        self.owners = {}
+
+        # Messages from the workers, and the latest snapshot of each live worker's metrics
+        self.outbox = _context.Queue()
+        self.worker_snapshots = {}
+
+        self._next_worker_id = 0
+
+    def start(self):
+        """Start one worker per shard, then keep watch over them."""
+        for shard in range(self.shards):
+            self.spawn({shard})
+        asyncio.ensure_future(self.watch())
+
+    def spawn(self, owned_shards):
+        """Start a worker process owning the given shards."""
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        inbox = _context.Queue()
+        process = _context.Process(target=run_worker, name='ShardWorker-{}'.format(worker_id),
+                                   args=(worker_id, set(owned_shards), self.server_config, inbox,
+                                         self.outbox, self.check_interval),
+                                   daemon=True)
+        process.start()
+        self.workers[worker_id] = (process, inbox)
+        for shard in owned_shards:
+            self.owners[shard] = worker_id
+        return worker_id
+
+    def send(self, worker_id: int, *message):
+        """Put a message in a worker's inbox."""
+        self.workers[worker_id][1].put(message)
+
+    async def submit(self, job: Job):
+        """Hand a new (or changed) job to the worker owning its shard."""
+        self.send(self.owners[job.id % self.shards], 'job', job.id)
+
+    async def submit_many(self, jobs):
+        """Hand a batch of new jobs to the workers, one message per worker."""
+        batches = {}
+        for job in jobs:
+            batches.setdefault(self.owners[job.id % self.shards], []).append(job.id)
+        for worker_id, job_ids in batches.items():
+            self.send(worker_id, 'jobs', job_ids)
+
+    async def cancel(self, job_id: int):
+        """Have the worker owning a job stop scheduling it."""
+        self.send(self.owners[job_id % self.shards], 'cancel', job_id)
+
+    def shards_of(self, worker_id: int):
+        """Shards owned by a worker."""
+        return [shard for shard, owner in self.owners.items() if owner == worker_id]
+
+    async def watch(self):
+        """Check on the workers every `check_interval` seconds. A failed check is logged and tried
+        again, so the shards always end up with a live owner."""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                self.read_outbox()
+                self.replace_dead()
+            except Exception as e:
+                self << 'Could not replace dead workers: {!r}'.format(e)
+
+    def read_outbox(self):
+        """Take in the messages the workers sent since the last check."""
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except Empty:
+                return
+            if message[0] == 'metrics' and message[1] in self.workers:
+                self.worker_snapshots[message[1]] = message[2]
+
+    def worker_metrics(self):
+        """The latest snapshot of each live worker's metrics."""
+        return list(self.worker_snapshots.values())
+
+    def replace_dead(self):
+        """Replace dead workers. A replacement is started first, then the shards of the dead worker
+        go to the idlest workers, counting the replacement (which may be the only one left)."""
+        dead = [worker_id for worker_id, (process, _) in self.workers.items()
+                if not process.is_alive()]
+        for worker_id in dead:
+            orphans = self.shards_of(worker_id)
+            del self.workers[worker_id]
+
+            # Keep what the worker counted, so the totals don't go back down
+            snapshot = self.worker_snapshots.pop(worker_id, None)
+            if snapshot is not None:
+                metrics.absorb(snapshot)
+            self << 'Worker {} died, reassigning shards {}.'.format(worker_id, orphans)
+            self.spawn(())
+            for shard in orphans:
+                self.reassign(shard, self.least_loaded())
+        if dead:
+            self.rebalance()
+
+    def least_loaded(self):
+        """Id of the worker owning the fewest shards."""
+        return min(self.workers, key=lambda worker_id: len(self.shards_of(worker_id)))
+
+    def reassign(self, shard: int, worker_id: int):
+        """Move a shard to another worker. The old owner (if it is alive) lets go of it first."""
+        old_owner = self.owners.get(shard)
+        if old_owner == worker_id:
+            return
+        if old_owner in self.workers:
+            self.send(old_owner, 'release', shard)
+        self.owners[shard] = worker_id
+        self.send(worker_id, 'adopt', shard)
+
+    def rebalance(self):
+        """Move shards from the busiest workers to the idlest until they own about as many each."""
+        while True:
+            busiest = max(self.workers, key=lambda worker_id: len(self.shards_of(worker_id)))
+            idlest = self.least_loaded()
+            if len(self.shards_of(busiest)) - len(self.shards_of(idlest)) <= 1:
+                break
+            self.reassign(self.shards_of(busiest)[-1], idlest)
+
+    def stop(self):
+        """Stop every worker."""
+        for worker_id in self.workers:
+            self.send(worker_id, 'stop')
+        for process, _ in self.workers.values():
+            process.join(timeout=5)
+
+    def __lshift__(self, msg):
+        """Helper function for printing a message."""
+        msg = '[ShardSupervisor] ' + msg
+        print(msg)
@@ -14,11 +14,12 @@ from tornado.web import Application as TornadoApplication, HTTPError
 from tornado.log import enable_pretty_logging
 from tornado.httpserver import HTTPServer
 
-from .database import DB
-from .routes import IndexPageHandler, RegisterPageHandler, LoginPageHandler, JobPageHandler
+from .database import DB, ResultRetention
+from .routes import IndexPageHandler, RegisterPageHandler, LoginPageHandler, JobPageHandler, \
+    JobBulkPageHandler, JobStatsPageHandler, MetricsPageHandler
 from .utils import ConfigParser
-from .utils.dates import now
-from .scheduler import JobScheduler
+from .utils.dates import now, set_timezone
+from .scheduler import JobScheduler, JobRunnerRegistry, ShardSupervisor
 
 
 class ServerApp(TornadoApplication):
@@ -35,10 +36,14 @@ class ServerApp(TornadoApplication):
             (r'/register', RegisterPageHandler),
             (r'/login', LoginPageHandler),
             (r'/job', JobPageHandler),
+            (r'/job/bulk', JobBulkPageHandler),
+            (r'/job/stats', JobStatsPageHandler),
+            (r'/metrics', MetricsPageHandler),
         ]
 
         # Parse the server config file
         server_config = ConfigParser()
+        set_timezone(server_config.timezone)
 
         # Application private key
         self.private_key = bytes(server_config.app_key, 'utf8')
@@ -61,12 +66,24 @@ class ServerApp(TornadoApplication):
         super().__init__(routes_to_handlers, **settings)
 
         # Initiate a shared connection to the database
-        self.db = DB(server_config.db_file)
-
-        # Initiate a threaded job scheduler
-
-        work_queue = asyncio.Queue()
-        self.scheduler = JobScheduler(work_queue, self.db, loop)
+        self.db = DB(server_config.db_file,
+                     commit_batch_size=server_config.db_commit_batch_size,
+                     commit_window=server_config.db_commit_window,
+                     read_pool_size=server_config.db_read_pool_size,
+                     wal=server_config.db_wal)
+
+        # Rolls up and deletes old job results in the background
+        self.retention = ResultRetention.from_config(server_config, self.db)
+
+        # Job types and their runners, shared by the routes and the scheduler
+        self.registry = JobRunnerRegistry(server_config.job_runners, server_config.runner_options)
+
+        # Initiate a threaded job scheduler (with an event loop of its own), or when sharding, a
+        # supervisor for the scheduler worker processes
+        if server_config.scheduler_shards:
+            self.scheduler = ShardSupervisor(server_config)
+        else:
+            self.scheduler = JobScheduler.from_config(server_config, self.db, self.registry)
 
     def run(self):
         """Start the tornado server."""
@@ -74,21 +91,22 @@ class ServerApp(TornadoApplication):
         http_server.listen(self.settings['app_port'])
 
     async def setup_db(self):
-        """Create database schema if database is empty."""
-        tables = await self.db.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        if len(tables) is 0:
-            print('No tables found in database. Generating schema..')
-            schema_sql = open('src/database/sql/schema.sql', 'r').read()
-            await self.db.executescript(schema_sql)
-            print('Schema generated successfully.')
+        """Bring the database schema up to date and load the job types, then start the scheduler
+        and the retention of job results."""
+        for migration in await self.db.migrate():
+            print('Applied migration {}.'.format(migration))
+
+        # The runners are loaded by the scheduler, on its own loop
+        await self.registry.load(self.db, None, runners=False)
         self.scheduler.start()
+        self.retention.start()
 
     async def generate_auth_token(self, user_id):
         """Generate an auth token for the user."""
         user = await self.db.execute('SELECT * FROM user WHERE id = ?;', user_id)
         if user:
             user = user[0]
-            token_data = bytes((user[1] + ':' + ':' + str(now().timestamp())), 'utf8')
+            token_data = bytes((user[1] + ':' + ':' + str(now(as_utc=True))), 'utf8')
             token = hashlib.blake2b(digest_size=16, key=self.private_key)
             token.update(token_data)
             token = '{0}:{1}'.format(token.hexdigest(), user[1])
@@ -14,19 +14,22 @@ from yaml.scanner import ScannerError
 class ConfigParser(object):
     """Parse the contents of the application config.yaml."""
 
-    def __init__(self):
+    def __init__(self, file_path: str = None):
+
+        # The config file can be swapped out (e.g. by the benchmarks) with VEGGIECRON_CONFIG
+        file_path = file_path or os.environ.get('VEGGIECRON_CONFIG', 'config.yaml')
 
         # Parse the server config file
         server_config = None
         try:
-            server_config = yaml.load(open('config.yaml', 'r'))
+            server_config = yaml.load(open(file_path, 'r'))
         except FileNotFoundError:
-            file_path = os.path.abspath('config.yaml')
+            file_path = os.path.abspath(file_path)
             print('Error: Could not locate config.yaml at {}'.format(file_path))
             exit()
         except ScannerError as e:
             print(e)
-            print('Error: Improper YAML in config.yaml.')
+            print('Error: Improper YAML in {}.'.format(file_path))
             exit()
         finally:
             if type(server_config) is not dict:
@@ -40,3 +43,50 @@ class ConfigParser(object):
         self.host = server_config['host']
         self.port = server_config['port']
         self.db_file = server_config['db_file']
+
+        # Timezone of the dates shown to users and of the times of day in schedules
+        self.timezone = server_config.get('timezone', 'US/Central')
+
+        # Database tuning, every key is optional
+        database = server_config.get('database') or {}
+        self.db_commit_batch_size = int(database.get('commit_batch_size', 500))
+        self.db_commit_window = float(database.get('commit_window_ms', 5)) / 1000
+        self.db_read_pool_size = int(database.get('read_pool_size', 4))
+        self.db_wal = bool(database.get('wal', True))
+
+        # Retention of job results, every key is optional. 0 turns a limit off.
+        retention = server_config.get('retention') or {}
+        self.retention_keep_results = int(retention.get('keep_results', 1000))
+        self.retention_keep_days = float(retention.get('keep_days', 30))
+        self.retention_hourly_days = float(retention.get('hourly_days', 30))
+        self.retention_interval = float(retention.get('interval_seconds', 300))
+        self.retention_batch_size = int(retention.get('batch_size', 500))
+        self.retention_vacuum_pages = int(retention.get('vacuum_pages', 1000))
+
+        # Mapping of username -> that user's own "keep_results" and "keep_days"
+        self.retention_users = retention.get('users') or {}
+
+        # Mapping of job type name -> runner class. Paths starting with "." are relative to
+        # src.scheduler.job_runners.
+        self.job_runners = server_config.get('job_runners') or {'http': '.http.HTTPJobRunner'}
+
+        # Mapping of job type name -> options for its runner
+        self.runner_options = server_config.get('runner_options') or {}
+
+        # Scheduler tuning, every key is optional
+        scheduler = server_config.get('scheduler') or {}
+        self.scheduler_window = float(scheduler.get('window_seconds', 0))
+        self.scheduler_misfire_grace = float(scheduler.get('misfire_grace_seconds', 1))
+        self.scheduler_catchup_window = float(scheduler.get('catchup_window_seconds', 60))
+        self.scheduler_catchup_jitter = float(scheduler.get('catchup_jitter', 0.5))
+        self.scheduler_max_catchup_fires = int(scheduler.get('max_catchup_fires', 100))
+
+        # Number of scheduler worker processes, each running one shard of the jobs. 0 runs the
+        # scheduler in the API process.
+        self.scheduler_shards = int(scheduler.get('shards', 0))
+
+        # Seconds a scheduler's claim on a running job lasts without being renewed
+        self.scheduler_lease_seconds = float(scheduler.get('lease_seconds', 60))
+
+        # Run the scheduler's event loop on uvloop, if it is installed
+        self.scheduler_uvloop = bool(scheduler.get('uvloop', False))
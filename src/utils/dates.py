@@ -3,24 +3,71 @@ src/utils/dates.py
 
 This file contains utility functions for handling dates in this project. SQLite doesn't support
 any date or time types by default, so I am using UTC timestamps.
+
+The hot paths work in plain float timestamps. Datetimes are only built where dates are shown to
+users, and the timezone lookups needed by daily schedules are cached.
 """
 
+import time
 import pytz
 
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
+
+
+# Timezone used for all dates in this project, set from config.yaml by set_timezone()
+timezone = pytz.timezone('US/Central')
+
+# Day number of 1970-01-01, for turning timestamps into dates without building datetimes
+_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+
+def set_timezone(name: str):
+    """Use another timezone for all dates. Call before any job is scheduled."""
+    global timezone
+    timezone = pytz.timezone(name)
+    _utc_offset.cache_clear()
+    local_timestamp.cache_clear()
 
 
 def now(as_utc=False):
-    """Get the current time with correct timezone."""
+    """Get the current time with correct timezone. With `as_utc`, a plain UTC timestamp."""
     if as_utc:
-        return datetime.now(tz=pytz.timezone('US/Central')).timestamp()
+        return time.time()
     else:
-        return datetime.now(tz=pytz.timezone('US/Central'))
+        return datetime.now(tz=timezone)
+
+
+@lru_cache(maxsize=4096)
+def _utc_offset(quarter_hour: int):
+    """Seconds the timezone is ahead of UTC, during the given quarter hour since the epoch.
+    Offsets only change on (at most) quarter hour boundaries, so they are looked up once per
+    quarter hour."""
+    return datetime.fromtimestamp(quarter_hour * 900, tz=timezone).utcoffset().total_seconds()
+
+
+def local_date(utc: float):
+    """The date in the project's timezone at a UTC timestamp."""
+    offset = _utc_offset(int(utc // 900))
+    return date.fromordinal(_epoch_ordinal + int((utc + offset) // 86400))
+
+
+def local_time(utc: float):
+    """The date, and the number of seconds into that day, in the project's timezone at a UTC
+    timestamp."""
+    days, seconds = divmod(utc + _utc_offset(int(utc // 900)), 86400)
+    return date.fromordinal(_epoch_ordinal + int(days)), seconds
+
+
+@lru_cache(maxsize=4096)
+def local_timestamp(year: int, month: int, day: int, hour: int = 0, minute: int = 0):
+    """UTC timestamp of a date and time of day in the project's timezone."""
+    return timezone.localize(datetime(year, month, day, hour, minute)).timestamp()
 
 
 def utc_to_date(utc: float):
     """Translate a UTC number to a Python datetime."""
-    return datetime.fromtimestamp(utc, tz=pytz.timezone('US/Central'))
+    return datetime.fromtimestamp(utc, tz=timezone)
 
 
 def compare_utc_dates(utc1: float, op: str, utc2: float):
@@ -0,0 +1,287 @@
+"""
+src/utils/metrics.py
+
+Counters, gauges and histograms for the hot paths (job fire lag, queue depths, database waits, HTTP
+requests in flight), rendered in the Prometheus text format by the "/metrics" route. Recording a
+value is a few attribute updates, so they can be left on everywhere. Other processes (such as the
+scheduler workers) send snapshots of their metrics, which are added to this process' when rendered.
+"""
+
+import bisect
+import threading
+
+
+# Upper bounds (in seconds) of the buckets of a latency histogram
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value):
+    """Format a sample value the way Prometheus expects it."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """A named metric, optionally split by labels. Each combination of label values gets a child
+    holding its own value; an unlabelled metric has a single child."""
+
+    type_name = None
+
+    def __init__(self, name: str, help_: str, label_names=()):
+        """Constructor."""
+        self.name = name
+        self.help = help_
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._default = None if self.label_names else self.labels()
+
+    def labels(self, *label_values):
+        """The child for the given label values, created on first use."""
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def merge_states(state, other):
+        """Add up the values of the same child in two processes."""
+        return state + other
+
+    def samples(self, state):
+        """(Name suffix, extra labels, value) of each sample of a child's value."""
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Mapping of label values -> value of every child, as passed to render()."""
+        return {label_values: child.state() for label_values, child in self._children.items()}
+
+    def render(self, others=()):
+        """Lines of the Prometheus text format for this metric, adding up the values in the
+        snapshots of other processes."""
+        states = self.snapshot()
+        for other in others:
+            for label_values, state in other.items():
+                states[label_values] = state if label_values not in states else \
+                    self.merge_states(states[label_values], state)
+
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        for label_values, state in sorted(states.items()):
+            labels = ['{}="{}"'.format(name, value)
+                      for name, value in zip(self.label_names, label_values)]
+            for suffix, extra_labels, value in self.samples(state):
+                lines.append('{}{}{} {}'.format(
+                    self.name, suffix,
+                    '{' + ','.join(labels + extra_labels) + '}' if labels or extra_labels else '',
+                    format_value(value)))
+        return lines
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def state(self):
+        return self.value
+
+    def add_state(self, state):
+        self.value += state
+
+
+class Counter(Metric):
+    """A count which only goes up."""
+
+    type_name = 'counter'
+
+    def new_child(self):
+        return _CounterValue()
+
+    def samples(self, state):
+        return [('_total', [], state)]
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _GaugeValue(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def state(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(Metric):
+    """A value which goes up and down. May be read from a function when it is scraped instead. The
+    values of several processes are added up."""
+
+    type_name = 'gauge'
+
+    def new_child(self):
+        return _GaugeValue()
+
+    def samples(self, state):
+        return [('', [], state)]
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        """Read the value from `function()` whenever the metric is scraped."""
+        self._default.function = function
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+        # Values are observed from the database threads as well as the event loop
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def state(self):
+        with self._lock:
+            return tuple(self.counts), self.sum
+
+    def add_state(self, state):
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, state[0])]
+            self.sum += state[1]
+
+
+class Histogram(Metric):
+    """Counts of observed values (such as latencies) in buckets, with their sum."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_: str, label_names=(), buckets=latency_buckets):
+        """Constructor."""
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_, label_names)
+
+    def new_child(self):
+        return _HistogramValue(self.buckets)
+
+    @staticmethod
+    def merge_states(state, other):
+        return tuple(a + b for a, b in zip(state[0], other[0])), state[1] + other[1]
+
+    def samples(self, state):
+        counts, sum_ = state
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', ['le="{}"'.format(format_value(float(bound)))], cumulative))
+        samples.append(('_sum', [], sum_))
+        samples.append(('_count', [], cumulative))
+        return samples
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+# Mapping of Prometheus type name -> metric class
+metric_types = {metric_class.type_name: metric_class
+                for metric_class in (Counter, Gauge, Histogram)}
+
+
+class MetricsRegistry(object):
+    """Every metric of the process, by name."""
+
+    def __init__(self):
+        """Constructor."""
+        self._metrics = {}
+
+    def _get(self, metric_class, name, *args, **kwargs):
+        """The metric with the given name, created the first time it is asked for."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, help_: str, label_names=()) -> Counter:
+        return self._get(Counter, name, help_, label_names)
+
+    def gauge(self, name: str, help_: str, label_names=()) -> Gauge:
+        return self._get(Gauge, name, help_, label_names)
+
+    def histogram(self, name: str, help_: str, label_names=(),
+                  buckets=latency_buckets) -> Histogram:
+        return self._get(Histogram, name, help_, label_names, buckets)
+
+    def snapshot(self):
+        """Values of every metric, picklable so they can be sent to another process and passed to
+        its render(). Maps each name -> (type, help, label names, buckets, values by label values).
+        """
+        return {name: (metric.type_name, metric.help, metric.label_names,
+                       getattr(metric, 'buckets', None), metric.snapshot())
+                for name, metric in self._metrics.items()}
+
+    def _register(self, snapshot: dict):
+        """Register the metrics of a snapshot which aren't recorded by this process, empty."""
+        for name, (type_name, help_, label_names, buckets, _) in snapshot.items():
+            if name not in self._metrics:
+                if type_name == 'histogram':
+                    self.histogram(name, help_, label_names, buckets)
+                else:
+                    self._get(metric_types[type_name], name, help_, label_names)
+
+    def absorb(self, snapshot: dict):
+        """Add the counters and histograms of another process (which has stopped) to this process'
+        own, so they keep counting up. Its gauges are dropped."""
+        self._register(snapshot)
+        for name, (type_name, _, _, _, states) in snapshot.items():
+            if type_name == 'gauge':
+                continue
+            metric = self._metrics[name]
+            for label_values, state in states.items():
+                metric.labels(*label_values).add_state(state)
+
+    def render(self, others=()):
+        """Every metric in the Prometheus text format, adding up the values of this process and the
+        snapshots of other processes."""
+        for other in others:
+            self._register(other)
+
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render([other[name][4] for other in others
+                                                     if name in other]))
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by everything in the process
+metrics = MetricsRegistry()
@@ -0,0 +1,70 @@
+"""
+src/utils/sketch.py
+
+A streaming quantile sketch for latencies. Values are counted in buckets whose bounds grow
+geometrically, so any quantile is answered within a fixed relative error from a few hundred counters
+at most, however many values were added. Two sketches merge by adding their counts, which is how the
+stats of a job run by several processes are combined.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+    """Counts of positive values in logarithmic buckets, with a relative error of `accuracy`."""
+
+    # Values below this are counted as zero
+    min_value = 1e-6
+
+    def __init__(self, accuracy: float = 0.01, counts: dict = None, zeros: int = 0):
+        """Constructor."""
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        # Mapping of bucket index -> count. Bucket i holds the values in (gamma^(i-1), gamma^i].
+        self.counts = dict(counts or {})
+        self.zeros = zeros
+        self.count = self.zeros + sum(self.counts.values())
+
+    def add(self, value: float, count: int = 1):
+        """Count a value."""
+        self.count += count
+        if value < self.min_value:
+            self.zeros += count
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        """Add the counts of another sketch (with the same accuracy) to this one."""
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def quantile(self, q: float):
+        """Estimated value at quantile `q` (0 to 1), or None if nothing was added."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if rank < seen:
+                # Middle of the bucket, so the error is at most `accuracy` either way
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.counts) / (self.gamma + 1)
+
+    def to_dict(self):
+        """JSON serializable form of the sketch."""
+        return {'accuracy': self.accuracy, 'zeros': self.zeros,
+                'counts': {str(index): count for index, count in self.counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Sketch from the output of `to_dict()`."""
+        return cls(data['accuracy'], {int(index): count for index, count in data['counts'].items()},
+                   data['zeros'])
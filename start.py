@@ -25,4 +25,5 @@ if __name__ == '__main__':
     try:
         loop.run_forever()
     finally:
+        app.scheduler.stop()
         app.db.close()